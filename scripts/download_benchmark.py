@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+"""
+Throughput and memory benchmark for the download service
+
+Creates synthetic user/project trees under a temporary USERS_PATH, starts download_endpoint.make_app() in a child
+process with Hub token validation stubbed out, drives it with concurrent downloads and prints the throughput,
+time to first byte and the service's peak RSS as JSON.
+
+Example, comparing plain and gzip downloads of 100 MB text files:
+
+    python download_benchmark.py --sizes 100M --content text -o plain.json
+    python download_benchmark.py --sizes 100M --content text --accept-encoding gzip --compressed-cache -o gzip.json
+
+Compressed copies are only sent from the cache, so --accept-encoding has no effect without --compressed-cache, and
+the first download of each file is sent as it is while its copy is compressed in the background.
+"""
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+
+
+TOKEN = 'benchmark'
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the g2nb download service')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='Number of concurrent clients')
+    parser.add_argument('-d', '--duration', type=float, default=30, help='Seconds to run the benchmark for')
+    parser.add_argument('-s', '--sizes', type=str, default='64K,1M,100M', help='Comma separated file sizes, ex: 10M,1G')
+    parser.add_argument('-f', '--files', type=int, default=4, help='Number of files of each size per project')
+    parser.add_argument('-u', '--users', type=int, default=4, help='Number of users, each with one project')
+    parser.add_argument('--content', choices=['random', 'text'], default='random',
+                        help='Incompressible random bytes or compressible tab separated text')
+    parser.add_argument('-e', '--accept-encoding', type=str, default=None, help='Accept-Encoding header to send')
+    parser.add_argument('-a', '--archive', choices=['zip', 'tar.gz'], default=None,
+                        help='Download whole projects as archives instead of single files')
+    parser.add_argument('--compressed-cache', action='store_true', help='Enable the cache of compressed copies, needed to send them')
+    parser.add_argument('--no-limits', action='store_true', help='Lift the concurrency and bandwidth limits')
+    parser.add_argument('--root', type=str, default=None, help='Directory to create the trees in, defaults to a temp dir')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Write the JSON results here as well as stdout')
+    return parser.parse_args()
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    return int(float(size[:-1]) * UNITS[size[-1]]) if size[-1] in UNITS else int(size)
+
+
+def write_file(path, size, content):
+    """Write a file of the given size, repeating a 1 MB block so large files are quick to create"""
+    if content == 'random': block = os.urandom(min(size, UNITS['M']))
+    else:
+        rows, length = [], 0
+        while length < min(size, UNITS['M']):
+            row = f'GENE{random.randint(1, 60000)}\tna\t' + '\t'.join(f'{random.gauss(0, 2):.4f}' for i in range(20)) + '\n'
+            rows.append(row)
+            length += len(row)
+        block = ''.join(rows).encode('ascii')
+    with open(path, 'wb') as f:
+        for start in range(0, size, len(block)): f.write(block[:size - start])
+
+
+def create_trees(root, users, sizes, files, content):
+    """Create one project per user with files of each size, return the download paths of the files and projects"""
+    file_paths, project_paths = [], []
+    for u in range(users):
+        project = os.path.join(root, f'user{u}', 'project')
+        os.makedirs(project, exist_ok=True)
+        for size in sizes:
+            for i in range(files):
+                name = f'{size}-{i}.{"bin" if content == "random" else "gct"}'
+                path = os.path.join(project, name)
+                if not os.path.exists(path) or os.path.getsize(path) != size: write_file(path, size, content)
+                file_paths.append((f'user/user{u}/project/edit/{name}', size))
+        project_paths.append((f'user/user{u}/project/', sum(sizes) * files))
+    return file_paths, project_paths
+
+
+def serve(root, port, cache_dir, no_limits, ready):
+    """Run the download service in this process, called in the child process"""
+    os.environ.setdefault('JUPYTERHUB_API_TOKEN', TOKEN)
+    import download_endpoint
+    from tornado.ioloop import IOLoop
+    download_endpoint.DownloadHandler.USERS_PATH = root
+    download_endpoint.CompressedCache.CACHE_PATH = cache_dir
+    if no_limits:
+        download_endpoint.DownloadScheduler.MAX_ACTIVE = sys.maxsize
+        download_endpoint.DownloadScheduler.MAX_PER_USER = sys.maxsize
+        download_endpoint.DownloadScheduler.USER_RATE = 0
+
+    # Stub out the Hub, every request is from an admin
+    async def user_for_token(token, use_cache=False, sync=False):
+        return {'name': 'admin', 'admin': True} if token == TOKEN else None
+    download_endpoint.HubTokenCache.instance().auth.user_for_token = user_for_token
+
+    download_endpoint.make_app().listen(port, address='127.0.0.1')
+    ready.set()
+    IOLoop.current().start()
+
+
+def peak_rss(pid):
+    """Return the process's peak resident set size in MB, or None if /proc isn't available"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'): return round(int(line.split()[1]) / 1024, 2)
+    except OSError: pass
+    return None
+
+
+def percentile(values, p):
+    if not values: return None
+    return round(values[max(0, math.ceil(p / 100 * len(values)) - 1)] * 1000, 3)
+
+
+async def client(base_url, targets, args, deadline, results):
+    """Download random targets until the deadline, counting bytes as they arrive rather than keeping them"""
+    http = AsyncHTTPClient()
+    headers = {'Accept-Encoding': args.accept_encoding} if args.accept_encoding else {}
+    while time.perf_counter() < deadline:
+        path, size = random.choice(targets)
+        received, first_byte = 0, None
+        start = time.perf_counter()
+
+        def on_chunk(chunk):
+            nonlocal received, first_byte
+            if first_byte is None: first_byte = time.perf_counter() - start
+            received += len(chunk)
+
+        try:
+            await http.fetch(f'{base_url}{TOKEN}/{path}', headers=headers, streaming_callback=on_chunk,
+                             decompress_response=False, request_timeout=3600)
+            results['durations'].append(time.perf_counter() - start)
+            results['ttfb'].append(first_byte or 0)
+            results['bytes_sent'] += received
+            results['bytes_original'] += size
+        except (HTTPClientError, OSError):
+            results['errors'] += 1
+
+
+async def run(base_url, targets, args):
+    results = {'durations': [], 'ttfb': [], 'bytes_sent': 0, 'bytes_original': 0, 'errors': 0}
+    AsyncHTTPClient.configure(None, max_clients=args.concurrency, max_body_size=sys.maxsize)
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(*[client(base_url, targets, args, deadline, results) for i in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+
+    durations, ttfb = sorted(results['durations']), sorted(results['ttfb'])
+    return {
+        'concurrency': args.concurrency,
+        'duration': round(elapsed, 3),
+        'sizes': args.sizes,
+        'content': args.content,
+        'accept_encoding': args.accept_encoding,
+        'archive': args.archive,
+        'downloads': len(durations),
+        'errors': results['errors'],
+        'downloads_per_second': round(len(durations) / elapsed, 2),
+        'mb_per_second': round(results['bytes_sent'] / elapsed / UNITS['M'], 2),
+        'original_mb_per_second': round(results['bytes_original'] / elapsed / UNITS['M'], 2),
+        'ttfb_p50_ms': percentile(ttfb, 50),
+        'ttfb_p95_ms': percentile(ttfb, 95),
+        'ttfb_p99_ms': percentile(ttfb, 99),
+        'download_p50_ms': percentile(durations, 50),
+        'download_p95_ms': percentile(durations, 95),
+        'download_max_ms': percentile(durations, 100)}
+
+
+def main():
+    args = parse_args()
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+
+    # Find a free port for the service
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    temp_dir = tempfile.TemporaryDirectory()
+    root = args.root or os.path.join(temp_dir.name, 'users')
+    file_paths, project_paths = create_trees(root, args.users, sizes, args.files, args.content)
+    if args.archive: targets = [(f'{path}?archive={args.archive}', size) for path, size in project_paths]
+    else: targets = file_paths
+    cache_dir = os.path.join(temp_dir.name, 'cache') if args.compressed_cache else ''
+
+    ready = multiprocessing.Event()
+    service = multiprocessing.Process(target=serve, args=(root, port, cache_dir, args.no_limits, ready), daemon=True)
+    service.start()
+    if not ready.wait(timeout=60): sys.exit('Download service failed to start')
+    baseline_rss = peak_rss(service.pid)
+
+    try:
+        report = asyncio.run(run(f'http://127.0.0.1:{port}/services/download/', targets, args))
+        report['baseline_rss_mb'] = baseline_rss
+        report['peak_rss_mb'] = peak_rss(service.pid)
+    finally:
+        service.terminate()
+        service.join()
+        temp_dir.cleanup()
+
+    output = json.dumps(report, indent=4)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f: f.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,61 +1,697 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from tornado.iostream import IOStream, StreamClosedError
 from tornado.web import Application, RequestHandler
 from tornado.ioloop import IOLoop
 from jupyterhub.services.auth import HubAuth
+import asyncio
+import gzip
+import hashlib
+import io
 import logging
 import os
+import tarfile
+import tempfile
+import time
+import zipfile
+import zlib
+
+# zstd is offered to clients only if the optional zstandard package is installed
+try: import zstandard
+except ImportError: zstandard = None
+
+
+class HubTokenCache:
+    """Process-wide verification of Hub API tokens, shared by all handlers
+
+       Keeps a bounded LRU of recently validated tokens and briefly remembers rejected ones, so that a burst of
+       downloads from the same admin session makes a single request to the Hub"""
+    _cache_singleton = None
+
+    MAX_ENTRIES = 1024  # Number of tokens to remember
+    TTL = 60            # Seconds to trust a validated token
+    NEGATIVE_TTL = 10   # Seconds to remember a rejected token
+
+    def __init__(self, api_token):
+        self.auth = HubAuth(api_token=api_token, cache_max_age=0)
+        self.entries = OrderedDict()    # Hash of the token -> (expiry time, user model or None if rejected)
+        self.pending = {}               # Hash of the token -> in-flight request to the Hub
+        self.counters = {'hits': 0, 'negative_hits': 0, 'shared': 0, 'misses': 0, 'errors': 0}
+
+    @classmethod
+    def instance(cls):
+        """Return the singleton, raise KeyError if the API token is missing from the environment"""
+        if cls._cache_singleton is None:
+            cls._cache_singleton = HubTokenCache(os.environ['JUPYTERHUB_API_TOKEN'])
+        return cls._cache_singleton
+
+    async def user_for_token(self, token):
+        """Return the Hub user model for the token, or None if it cannot be authenticated"""
+        key = hashlib.sha256(token.encode('UTF-8')).hexdigest()  # Don't keep raw tokens in memory longer than needed
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.counters['hits' if entry[1] is not None else 'negative_hits'] += 1
+            return entry[1]
+
+        # Concurrent lookups of the same token share one request to the Hub
+        if key in self.pending:
+            self.counters['shared'] += 1
+            return await self.pending[key]
+
+        self.counters['misses'] += 1
+        self.pending[key] = asyncio.ensure_future(self.auth.user_for_token(token, use_cache=False, sync=False))
+        try: user = await self.pending[key]
+        except Exception:
+            self.counters['errors'] += 1  # Hub errors are not cached
+            raise
+        finally: del self.pending[key]
+
+        self.entries[key] = (time.monotonic() + (self.TTL if user is not None else self.NEGATIVE_TTL), user)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.MAX_ENTRIES: self.entries.popitem(last=False)
+        return user
+
+    def stats(self):
+        return {'entries': len(self.entries), 'pending': len(self.pending), **self.counters}
+
+
+class CompressedCache:
+    """On-disk cache of compressed copies of downloaded files, keyed by the file's path, modification time and size
+
+       Copies are written in the background to a temp file and renamed into place once complete, so a copy is never
+       served half-written. Only complete copies are sent, so compressed downloads have a Content-Length and can be
+       resumed with a Range. The least recently served copies are removed once the cache grows past MAX_BYTES.
+
+       Disabled by default, as it keeps copies of users' files. Enable it by pointing DOWNLOAD_CACHE_PATH at a
+       directory the service may write to, ex: DOWNLOAD_CACHE_PATH=/data/download-cache"""
+    _cache_singleton = None
+
+    CACHE_PATH = os.getenv('DOWNLOAD_CACHE_PATH', '')  # Empty to disable, and to send every file uncompressed
+    MAX_BYTES = 10 * 1024 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.filling = set()  # Cached paths of the copies being written
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def instance(cls):
+        """Return the cache, or None if caching is disabled or the cache directory can't be created"""
+        if cls._cache_singleton is None and cls.CACHE_PATH:
+            try: cls._cache_singleton = CompressedCache(cls.CACHE_PATH)
+            except OSError as e:
+                logging.warning(f'Compressed download cache disabled: {e}')
+                cls.CACHE_PATH = None
+        return cls._cache_singleton
+
+    def cached_path(self, file_path, stat, encoding):
+        key = hashlib.sha256(f'{file_path}\0{stat.st_mtime_ns}\0{stat.st_size}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, f'{key}.{encoding}')
+
+    def open(self, file_path, stat, encoding):
+        """Return the open cached copy, or None if there isn't one yet"""
+        cached_path = self.cached_path(file_path, stat, encoding)
+        try:
+            f = open(cached_path, 'rb')
+            os.utime(cached_path)  # Track when it was last used, for pruning
+            self.hits += 1
+            return f
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+    def create(self, file_path, stat, encoding):
+        """Return an open temp file to write a new copy to"""
+        return tempfile.NamedTemporaryFile(dir=self.path, prefix='.', suffix=f'.{encoding}', delete=False)
+
+    def fill(self, file_path, stat, encoding, compressor, executor):
+        """Start writing a compressed copy of the file on the executor, unless one is already being written"""
+        cached_path = self.cached_path(file_path, stat, encoding)
+        if cached_path in self.filling: return
+        self.filling.add(cached_path)
+        future = executor.submit(self._fill, file_path, stat, encoding, compressor)
+        future.add_done_callback(lambda future: self.filling.discard(cached_path))
+
+    def _fill(self, file_path, stat, encoding, compressor):
+        temp = None
+        try:
+            temp = self.create(file_path, stat, encoding)
+            with open(file_path, 'rb') as f:
+                while True:
+                    data = f.read(DownloadHandler.CHUNK_SIZE)
+                    temp.write(compressor.compress(data) if data else compressor.flush())
+                    if not data: break
+                current = os.fstat(f.fileno())
+            # A file changed while being compressed would be cached under its old modification time and size
+            if (current.st_mtime_ns, current.st_size) == (stat.st_mtime_ns, stat.st_size):
+                self.store(temp, file_path, stat, encoding)
+                return
+        except OSError as e: logging.warning(f'Failed to cache a compressed copy of {file_path}: {e}')
+        if temp: CompressedCache.discard(temp)
+
+    def store(self, temp, file_path, stat, encoding):
+        """Move a completed temp file into place, then prune the cache"""
+        temp.close()
+        os.replace(temp.name, self.cached_path(file_path, stat, encoding))
+        self.stored += 1
+        self.prune()
+
+    @staticmethod
+    def discard(temp):
+        """Remove an incomplete temp file"""
+        temp.close()
+        try: os.remove(temp.name)
+        except FileNotFoundError: pass
+
+    def prune(self):
+        """Remove the least recently used copies until the cache is under MAX_BYTES"""
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.startswith('.') or not entry.is_file(): continue  # Skip copies still being written
+            try: stat = entry.stat()
+            except FileNotFoundError: continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = 0
+        for mtime, size, path in sorted(files, reverse=True):
+            total += size
+            if total > CompressedCache.MAX_BYTES:
+                try: os.remove(path)
+                except FileNotFoundError: pass
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'stored': self.stored}
+
+
+class TokenBucket:
+    """Limits the rate at which bytes are sent, shared by all of one user's downloads"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate        # Bytes per second
+        self.burst = burst      # Bytes that may be sent at once after a pause
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def consume(self, count):
+        """Wait until count bytes may be sent, callers going into debt wait in turn for it to be paid off"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= count
+        if self.tokens < 0: await asyncio.sleep(-self.tokens / self.rate)
+
+
+class DownloadScheduler:
+    """Caps the number of downloads running at once, overall and per user, and shapes each user's bandwidth
+
+       Requests over the caps wait in a FIFO queue, and are turned away once the queue is full."""
+    _scheduler_singleton = None
+
+    MAX_ACTIVE = 8                      # Downloads sent at once across all users
+    MAX_PER_USER = 2                    # Downloads sent at once for any one user
+    MAX_QUEUED = 64                     # Downloads waiting for a slot before new requests get a 503
+    RETRY_AFTER = 10                    # Seconds clients are asked to wait after a 503
+    USER_RATE = 100 * 1024 * 1024       # Bytes per second for each user, 0 for no limit
+    USER_BURST = 8 * 1024 * 1024        # Bytes a user may send at once after being idle
+
+    class QueueFull(Exception):
+        """Raised when a download can't be queued"""
+        pass
+
+    def __init__(self):
+        self.active = {}                # User -> number of downloads being sent
+        self.buckets = {}               # User -> TokenBucket, while the user has downloads being sent
+        self.waiting = []               # (user, future) in the order they were queued
+        self.counters = {'started': 0, 'waited': 0, 'rejected': 0}
+
+    @classmethod
+    def instance(cls):
+        if cls._scheduler_singleton is None: cls._scheduler_singleton = DownloadScheduler()
+        return cls._scheduler_singleton
+
+    async def acquire(self, user):
+        """Wait for a download slot, return the user's TokenBucket or None if bandwidth isn't limited"""
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append((user, future))
+        self._dispatch()
+        if not future.done():
+            if len(self.waiting) > DownloadScheduler.MAX_QUEUED:
+                self.waiting.remove((user, future))
+                self.counters['rejected'] += 1
+                raise DownloadScheduler.QueueFull()
+            self.counters['waited'] += 1
+        try: return await future
+        except asyncio.CancelledError:
+            # The client went away while waiting, give up its place in the queue or its slot
+            if (user, future) in self.waiting: self.waiting.remove((user, future))
+            elif future.done() and not future.cancelled(): self.release(user)
+            raise
+
+    def release(self, user):
+        """Free the user's slot when a download finishes, and start the next queued downloads"""
+        self.active[user] -= 1
+        if not self.active[user]:
+            del self.active[user]
+            self.buckets.pop(user, None)
+        self._dispatch()
+
+    def _dispatch(self):
+        """Start queued downloads in order, skipping those of users already at their cap"""
+        for user, future in list(self.waiting):
+            if sum(self.active.values()) >= DownloadScheduler.MAX_ACTIVE: break
+            if future.cancelled(): self.waiting.remove((user, future))
+            elif self.active.get(user, 0) < DownloadScheduler.MAX_PER_USER:
+                self.waiting.remove((user, future))
+                self.active[user] = self.active.get(user, 0) + 1
+                if DownloadScheduler.USER_RATE and user not in self.buckets:
+                    self.buckets[user] = TokenBucket(DownloadScheduler.USER_RATE, DownloadScheduler.USER_BURST)
+                self.counters['started'] += 1
+                future.set_result(self.buckets.get(user))
+
+    def stats(self):
+        return {'active': sum(self.active.values()), 'queued': len(self.waiting), 'active_users': len(self.active),
+                **self.counters}
+
+
+class ArchiveStream(io.RawIOBase):
+    """Write-only file object that hands archive bytes from an archiving thread to the IOLoop in bounded chunks
+
+       The thread blocks once the queue is full, so memory use stays constant however large the archive."""
+
+    class Cancelled(Exception):
+        """Raised in the archiving thread when the client has gone away"""
+        pass
+
+    def __init__(self, loop, chunk_size, max_chunks=4):
+        self.loop = loop
+        self.chunk_size = chunk_size
+        self.queue = asyncio.Queue(maxsize=max_chunks)
+        self.buffer = bytearray()
+        self.cancelled = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.cancelled: raise ArchiveStream.Cancelled()
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self._put(bytes(self.buffer))
+            self.buffer.clear()
+        return len(data)
+
+    def finish(self):
+        """Send any buffered bytes followed by the end of stream marker, called from the archiving thread"""
+        if self.buffer and not self.cancelled: self._put(bytes(self.buffer))
+        self._put(None)
+
+    def _put(self, chunk):
+        asyncio.run_coroutine_threadsafe(self.queue.put(chunk), self.loop).result()
+
+
+class ProjectArchive:
+    """Builds a zip or tar.gz of a directory on the fly, without writing a temp file"""
+
+    FORMATS = {'zip': 'application/zip', 'tar.gz': 'application/gzip'}
+    MAX_FILES = 100000                      # Directories with more files than this are refused
+    MAX_BYTES = 50 * 1024 * 1024 * 1024     # Directories larger than this are refused
+
+    def __init__(self, directory, archive_format='zip', level=6):
+        if archive_format not in ProjectArchive.FORMATS: raise ValueError(f'Unknown archive format: {archive_format}')
+        if level < 0 or level > 9: raise ValueError('Compression level must be between 0 and 9')
+        self.directory = directory
+        self.format = archive_format
+        self.level = level
+        self.name = os.path.basename(os.path.normpath(directory))
+
+    @property
+    def file_name(self):
+        return f'{self.name}.{self.format}'
+
+    def list_files(self):
+        """Walk the directory and return a list of (path, name in archive), raise OverflowError if over the caps
+
+           Symlinks are skipped so that the archive can't reach outside the directory."""
+        files, total = [], 0
+        for root, dirs, names in os.walk(self.directory):
+            dirs[:] = sorted(d for d in dirs if not os.path.islink(os.path.join(root, d)))
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                if os.path.islink(path) or not os.path.isfile(path): continue
+                total += os.path.getsize(path)
+                files.append((path, os.path.join(self.name, os.path.relpath(path, self.directory))))
+                if len(files) > ProjectArchive.MAX_FILES or total > ProjectArchive.MAX_BYTES:
+                    raise OverflowError(f'Directory exceeds the archive limit of {ProjectArchive.MAX_FILES} files '
+                                        f'or {ProjectArchive.MAX_BYTES} bytes')
+        return files
+
+    def write(self, stream, files):
+        """Write the archive to the stream, runs on an archiving thread"""
+        try:
+            if self.format == 'zip':
+                compression = zipfile.ZIP_DEFLATED if self.level else zipfile.ZIP_STORED
+                with zipfile.ZipFile(stream, 'w', compression=compression, compresslevel=self.level) as archive:
+                    for path, name in files: self._add(lambda: archive.write(path, name), path)
+            else:
+                with gzip.GzipFile(fileobj=stream, mode='wb', compresslevel=self.level) as compressed, \
+                        tarfile.open(fileobj=compressed, mode='w|') as archive:
+                    for path, name in files: self._add(lambda: archive.add(path, name, recursive=False), path)
+        except ArchiveStream.Cancelled: pass
+        finally: stream.finish()
+
+    @staticmethod
+    def _add(add, path):
+        # Files in a live home directory may disappear or become unreadable while being archived
+        try: add()
+        except (FileNotFoundError, PermissionError) as e: logging.warning(f'Skipping {path} in archive: {e}')
 
 
 class DownloadHandler(RequestHandler):
     """Download file endpoint for the GenePattern server"""
 
     USERS_PATH = '/data/users'
+    CHUNK_SIZE = 1024 * 1024            # Bytes read from disk and sent at a time
+    SENDFILE_THRESHOLD = 1024 * 1024    # Files at least this large are sent with os.sendfile() when possible
+    MAX_RANGES = 16                     # Requests for more byte ranges than this get the whole file
+    MIN_COMPRESS_SIZE = 1024            # Smaller files aren't worth compressing
+    COMPRESSION_LEVELS = {'zstd': 3, 'gzip': 6}
+    ENCODINGS = ['zstd', 'gzip'] if zstandard else ['gzip']  # In order of preference
+
+    # Files in these formats are already compressed, and are always sent as they are
+    COMPRESSED_EXTENSIONS = {'.gz', '.tgz', '.bz2', '.xz', '.zst', '.zip', '.7z', '.bam', '.cram', '.h5', '.h5ad',
+                             '.loom', '.parquet', '.png', '.jpg', '.jpeg', '.gif', '.pdf', '.mp4'}
 
-    def get(self, token=None, path=None):
-        # Get API key from the environment or return an error
-        try: api_token = os.environ['JUPYTERHUB_API_TOKEN']
+    # Disk reads happen on these threads, so a slow read never blocks other downloads
+    readers = ThreadPoolExecutor(max_workers=8, thread_name_prefix='download-reader')
+    archivers = ThreadPoolExecutor(max_workers=4, thread_name_prefix='download-archiver')
+
+    waiter = None   # Pending request for a download slot
+    bucket = None   # TokenBucket limiting this download's bandwidth, None if not limited
+
+    async def get(self, token=None, path=None):
+        # Get the shared token cache, which reads the API key from the environment, or return an error
+        try: token_cache = HubTokenCache.instance()
         except KeyError:
             self.send_error(500, reason='API key not found in environment')
             return
 
-        # Initialize a JupyterHub auth singleton, verify the incoming token and the user's admin privileges
-        auth = HubAuth(api_token=api_token, cache_max_age=60)
-        user = auth.user_for_token(token)  # Get the user, None if cannot be authenticated
+        # Verify the incoming token and the user's admin privileges
+        user = await token_cache.user_for_token(token)  # Get the user, None if cannot be authenticated
         if user is None or not user['admin']:
             self.send_error(403, reason='Token authentication or privilege check failed')
             return
 
+        # Wait for a free download slot, or turn the request away if too many are already waiting
+        scheduler = DownloadScheduler.instance()
+        self.waiter = asyncio.ensure_future(scheduler.acquire(user['name']))
+        try: self.bucket = await self.waiter
+        except DownloadScheduler.QueueFull:
+            # Not send_error(), which would clear the Retry-After header
+            self.set_status(503, reason='Too many downloads in progress')
+            self.set_header('Retry-After', DownloadScheduler.RETRY_AFTER)
+            self.finish()
+            return
+        except asyncio.CancelledError:
+            logging.info(f'Client disconnected while waiting to download {path}')
+            return
+
+        try:
+            # Directories may be downloaded as an archive, ex: ?archive=zip or ?archive=tar.gz&level=9
+            if self.get_argument('archive', None) is not None: await self._get_archive(path)
+            else: await self._get_file(path)
+        finally: scheduler.release(user['name'])
+
+    def on_connection_close(self):
+        """Give up the request's place in the download queue if the client goes away while waiting"""
+        if self.waiter and not self.waiter.done(): self.waiter.cancel()
+
+    async def _get_file(self, path):
+        """Send the requested file, or the requested byte ranges of it"""
         # Read the path, ensure that the requested file exists and is not a directory
         file_path = DownloadHandler._url_to_file_path(path)
         if not file_path or not os.path.exists(file_path) or os.path.isdir(file_path):
             self.send_error(404, reason='Requested file not found')
             return
 
-        # Serve the file download
-        buf_size = 4096
+        # Serve the file download, or the requested byte ranges of it
         file_name = os.path.basename(file_path)
         self.set_header('Content-Type', 'application/octet-stream')
         self.set_header('Content-Disposition', f'attachment; filename={file_name}')
         with open(file_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            # A compressed copy is only sent once the cache has all of it, so that its size is known and a download
+            # of it can be resumed, and not to a client resuming a download of the file as it is
+            encoding = self._content_encoding(file_path, stat)
+            if self.request.headers.get('If-Range') == DownloadHandler._etag(stat): encoding = None
+            cached = encoding and await self._open_compressed(file_path, stat, encoding)
+            if not cached: encoding = None
+            try:
+                body, size = (cached, os.fstat(cached.fileno()).st_size) if cached else (f, stat.st_size)
+                etag = DownloadHandler._etag(stat, encoding)
+                self.set_header('Accept-Ranges', 'bytes')
+                self.set_header('Vary', 'Accept-Encoding')
+                self.set_header('ETag', etag)
+                self.set_header('Last-Modified', datetime.fromtimestamp(int(stat.st_mtime), timezone.utc))
+                if encoding: self.set_header('Content-Encoding', encoding)
+                if self.check_etag_header():
+                    self.set_status(304)
+                    self.clear_header('Content-Encoding')
+                    self.finish()
+                    return
+
+                # Ranges of a compressed copy are byte offsets into the compressed copy, and the whole copy is sent
+                # rather than a multipart response, whose Content-Encoding would apply to the parts' headers too
+                ranges = self._requested_ranges(stat, size, etag)
+                if encoding and ranges and len(ranges) > 1: ranges = None
+                if ranges is None:
+                    self.set_header('Content-Length', size)
+                    await self._send(body, 0, size)
+                elif not ranges:
+                    # Not send_error(), which would clear the Content-Range header
+                    self.set_status(416, reason='Requested range not satisfiable')
+                    self.set_header('Content-Range', f'bytes */{size}')
+                    self.clear_header('Content-Disposition')
+                    self.clear_header('Content-Encoding')
+                elif len(ranges) == 1:
+                    start, end = ranges[0]
+                    self.set_status(206)
+                    self.set_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+                    self.set_header('Content-Length', end - start)
+                    await self._send(body, start, end - start)
+                else: await self._send_multipart(body, ranges, size)
+            except StreamClosedError:
+                logging.info(f'Client disconnected while downloading {file_path}')
+                return
+            finally:
+                if cached: cached.close()
+        if not self._finished: self.finish()
+
+    async def _get_archive(self, path):
+        """Stream a zip or tar.gz of the requested directory as it is being built"""
+        directory = DownloadHandler._url_to_file_path(path, allow_directory=True)
+        if not directory or not os.path.isdir(directory):
+            self.send_error(404, reason='Requested directory not found')
+            return
+        try:
+            archive = ProjectArchive(directory, self.get_argument('archive'), int(self.get_argument('level', 6)))
+            files = await IOLoop.current().run_in_executor(DownloadHandler.readers, archive.list_files)
+        except ValueError as e:
+            self.send_error(400, reason=str(e))
+            return
+        except OverflowError as e:
+            self.send_error(413, reason=str(e))
+            return
+
+        self.set_header('Content-Type', ProjectArchive.FORMATS[archive.format])
+        self.set_header('Content-Disposition', f'attachment; filename={archive.file_name}')
+        stream = ArchiveStream(asyncio.get_running_loop(), DownloadHandler.CHUNK_SIZE)
+        writer = IOLoop.current().run_in_executor(DownloadHandler.archivers, archive.write, stream, files)
+        try:
             while True:
-                data = f.read(buf_size)
-                if not data:
-                    break
-                self.write(data)
-        self.finish()
+                chunk = await stream.queue.get()
+                if chunk is None: break
+                await self._throttle(len(chunk))
+                self.write(chunk)
+                await self.flush()
+            await writer
+            self.finish()
+        except StreamClosedError:
+            logging.info(f'Client disconnected while downloading an archive of {directory}')
+            # Stop the archiving thread, emptying the queue in case it is waiting to add a chunk
+            stream.cancelled = True
+            while not writer.done():
+                while not stream.queue.empty(): stream.queue.get_nowait()
+                await asyncio.sleep(0.01)
+        except Exception:
+            # Close rather than finish the response, so the client can't mistake a truncated archive for a whole one
+            logging.exception(f'Failed to archive {directory}')
+            self.detach().close()
 
     @staticmethod
-    def _url_to_file_path(url_path):
+    def _etag(stat, encoding=None):
+        """Strong validator built from the file's inode, size and modification time, and any content encoding"""
+        return f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}{"-" + encoding if encoding else ""}"'
+
+    def _content_encoding(self, file_path, stat):
+        """Pick the client's most preferred encoding from Accept-Encoding, or None to send the file as it is"""
+        if stat.st_size < DownloadHandler.MIN_COMPRESS_SIZE: return None
+        if os.path.splitext(file_path)[1].lower() in DownloadHandler.COMPRESSED_EXTENSIONS: return None
+        accepted = {}
+        for part in self.request.headers.get('Accept-Encoding', '').split(','):
+            coding, _, params = part.strip().partition(';')
+            try: q = float(params.strip()[2:]) if params.strip().startswith('q=') else 1.0
+            except ValueError: q = 0.0
+            accepted[coding.strip().lower()] = q
+        candidates = [(accepted.get(e, accepted.get('*', 0)), -i, e) for i, e in enumerate(DownloadHandler.ENCODINGS)]
+        q, _, encoding = max(candidates)
+        return encoding if q > 0 else None
+
+    async def _open_compressed(self, file_path, stat, encoding):
+        """Return the open cached compressed copy of the file, or None if there isn't one yet, in which case one is
+           compressed in the background for later downloads"""
+        cache = CompressedCache.instance()
+        if not cache: return None
+        cached = await IOLoop.current().run_in_executor(DownloadHandler.readers, cache.open, file_path, stat, encoding)
+        if not cached:
+            cache.fill(file_path, stat, encoding, DownloadHandler._compressor(encoding), DownloadHandler.archivers)
+        return cached
+
+    @staticmethod
+    def _compressor(encoding):
+        """Return a streaming compressor with compress() and flush() methods"""
+        level = DownloadHandler.COMPRESSION_LEVELS[encoding]
+        if encoding == 'zstd': return zstandard.ZstdCompressor(level=level).compressobj()
+        return zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 writes a gzip header and trailer
+
+    def _requested_ranges(self, stat, size, etag):
+        """Parse the Range header into a sorted list of merged (start, end) byte offsets, end exclusive
+
+           Returns None to send the whole file: no Range, an unparseable Range, too many ranges or a stale If-Range.
+           Returns an empty list if none of the ranges can be satisfied."""
+        header = self.request.headers.get('Range')
+        if not header or not header.startswith('bytes=') or not self._if_range_matches(stat, etag): return None
+        ranges = []
+        for spec in header[len('bytes='):].split(','):
+            first, _, last = spec.strip().partition('-')
+            try:
+                if first == '':  # Suffix range, ex: -500 for the last 500 bytes
+                    start, end = max(0, size - int(last)), size
+                else: start, end = int(first), min(int(last) + 1, size) if last else size
+            except ValueError: return None
+            if start < 0 or (last and first and int(last) < start): return None
+            if start < end: ranges.append((start, end))
+        if len(ranges) > DownloadHandler.MAX_RANGES: return None
+
+        # Merge overlapping and adjacent ranges
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]: merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else: merged.append((start, end))
+        return merged
+
+    def _if_range_matches(self, stat, etag):
+        """A Range is only honored if any If-Range matches the ETag of the body being sent or the Last-Modified date"""
+        if_range = self.request.headers.get('If-Range')
+        if not if_range: return True
+        if if_range.startswith('"'): return if_range == etag
+        try: return parsedate_to_datetime(if_range).timestamp() >= int(stat.st_mtime)
+        except (TypeError, ValueError): return False
+
+    async def _send(self, f, offset, count):
+        """Send part of an open file, using sendfile() if possible"""
+        if self._can_sendfile(count): await self._sendfile(f, offset, count)
+        else: await self._stream(f, offset, count)
+
+    async def _send_multipart(self, f, ranges, size):
+        """Send several byte ranges of an open file as a multipart/byteranges response"""
+        boundary = hashlib.sha1(os.urandom(16)).hexdigest()
+        part_headers = [f'--{boundary}\r\nContent-Type: application/octet-stream\r\n'
+                        f'Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n'.encode('ascii') for start, end in ranges]
+        closing = f'\r\n--{boundary}--\r\n'.encode('ascii')
+
+        self.set_status(206)
+        self.set_header('Content-Type', f'multipart/byteranges; boundary={boundary}')
+        self.set_header('Content-Length', sum(len(h) + end - start for h, (start, end) in zip(part_headers, ranges))
+                        + 2 * (len(ranges) - 1) + len(closing))
+        for i, (start, end) in enumerate(ranges):
+            self.write((b'\r\n' if i else b'') + part_headers[i])
+            await self._stream(f, start, end - start)
+        self.write(closing)
+
+    async def _stream(self, f, offset, count):
+        """Send part of an open file one chunk at a time, waiting for each chunk to be sent before reading the next"""
+        f.seek(offset)
+        while count > 0:
+            data = await IOLoop.current().run_in_executor(DownloadHandler.readers, f.read, min(DownloadHandler.CHUNK_SIZE, count))
+            if not data: break  # The file was truncated while being sent
+            count -= len(data)
+            await self._throttle(len(data))
+            self.write(data)
+            await self.flush()
+
+    async def _throttle(self, count):
+        """Wait until count more bytes may be sent within the user's bandwidth"""
+        if self.bucket is not None: await self.bucket.consume(count)
+
+    def _can_sendfile(self, size):
+        """sendfile() needs a plain (non-TLS) HTTP/1 socket, and skips Tornado's output transforms"""
+        stream = getattr(self.request.connection, 'stream', None)
+        return (size >= DownloadHandler.SENDFILE_THRESHOLD and hasattr(os, 'sendfile') and type(stream) is IOStream
+                and self.request.method == 'GET')
+
+    async def _sendfile(self, f, offset, count):
+        """Send part of an open file straight from the page cache to the socket, then close the connection"""
+        await self.flush()  # Let Tornado send the headers
+        stream = self.detach()
+        sock = stream.socket.dup()  # Tornado may still have the original descriptor registered with the IOLoop
+        try:
+            if self.bucket is None: await asyncio.get_running_loop().sock_sendfile(sock, f, offset, count)
+            else:
+                # Send one chunk at a time to stay within the user's bandwidth
+                for start in range(offset, offset + count, DownloadHandler.CHUNK_SIZE):
+                    size = min(DownloadHandler.CHUNK_SIZE, offset + count - start)
+                    await self.bucket.consume(size)
+                    await asyncio.get_running_loop().sock_sendfile(sock, f, start, size)
+        except (ConnectionError, OSError) as e: raise StreamClosedError(real_error=e)
+        finally:
+            sock.close()
+            stream.close()
+
+    @staticmethod
+    def _url_to_file_path(url_path, allow_directory=False):
         # Break the api path up into its constituent components, ex: user/bob/project-name/edit/BRCA_HUGO_symbols.gct
-        [ user_directive, user, project, app_directive, relative_path ] = url_path.split('/', 4)
-        # Expected path sanity checks
-        if user_directive != 'user' or len(user) == 0 or len(project) == 0 or len(relative_path) == 0: return None
+        parts = url_path.split('/', 4)
+        [ user_directive, user, project, app_directive, relative_path ] = parts + [''] * (5 - len(parts))
+        # Expected path sanity checks, only directories may leave off the relative path (ex: user/bob/project-name/)
+        if user_directive != 'user' or len(user) == 0 or len(project) == 0: return None
+        if len(relative_path) == 0 and not allow_directory: return None
         # Construct the path and return
         return os.path.join(DownloadHandler.USERS_PATH, user, project, relative_path)
 
 
+class StatusHandler(RequestHandler):
+    """Endpoint for monitoring the download service"""
+
+    def get(self):
+        """Return the download scheduler's and caches' counters in JSON format"""
+        cache = CompressedCache.instance()
+        try: self.write({'downloads': DownloadScheduler.instance().stats(), 'token_cache': HubTokenCache.instance().stats(),
+                         'compressed_cache': cache and cache.stats()})
+        except KeyError:
+            self.send_error(500, reason='API key not found in environment')
+            return
+        self.finish()
+
+
 def make_app():
     # Assign handlers to the URLs and return
     urls = [
+        (r"/services/download/status/", StatusHandler),
         (r"/services/download/(?P<token>\w+)/(?P<path>.*)", DownloadHandler),
     ]
     return Application(urls, debug=True)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+"""
+Incremental index of filesystem usage
+
+Keeps one SQLite row per directory with the directory's mtime and the disk usage, file and notebook counts of the
+files directly inside it, plus the modification times of recently changed files. An update only lists directories
+whose mtime changed since they were last scanned; unchanged directories are stat'ed to check their mtime, and their
+known subdirectories are descended into without reading the directory itself.
+
+A directory's mtime changes when entries are added, removed or renamed, but not when a file inside it is rewritten in
+place, so sizes and recent modification counts can lag behind in-place edits. Directories are relisted once their
+row is older than RESCAN_DAYS, which bounds how stale the index can be, and --full relists everything.
+
+Disk usage is counted as du does (allocated blocks, including hidden files), except that hard links are counted once
+per directory they appear in. File and notebook counts exclude hidden files and directories, as find -not -path '*/.*'.
+
+Example, updating the index and printing the largest users:
+
+    python fs_index.py update /data/lab/ --users /data/lab/users/
+    python fs_index.py users
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+
+DB_PATH = '/data/lab/fs_index.sqlite'   # Path to the index database
+RECENT_DAYS = 35                        # Modification times are kept for files changed in this many days
+RESCAN_DAYS = 30                        # Directories are relisted after this many days even if their mtime is the same
+WORKERS = 16                            # Threads used to scan user and top-level directories in parallel
+
+
+def _subtree(path):
+    """Return the WHERE clause and parameters that select a directory and everything under it"""
+    path = os.path.abspath(path)
+    # '0' is the character after '/', so this range matches every path that starts with path + '/'
+    return '(path = ? OR (path >= ? AND path < ?))', (path, path + '/', path + '0')
+
+
+class FSIndex:
+    """Per-directory index of disk usage, file counts and recent modifications"""
+
+    def __init__(self, db_path=DB_PATH):
+        self.db = sqlite3.connect(db_path, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, user TEXT, '
+                            'mtime_ns INTEGER NOT NULL, hidden INTEGER NOT NULL, bytes INTEGER NOT NULL, '
+                            'files INTEGER NOT NULL, notebooks INTEGER NOT NULL, scanned REAL NOT NULL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS ix_dirs_parent ON dirs (parent)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS ix_dirs_user ON dirs (user)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS recent (dir TEXT NOT NULL, mtime REAL NOT NULL, '
+                            'notebook INTEGER NOT NULL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS ix_recent_dir ON recent (dir)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS ix_recent_mtime ON recent (mtime)')
+
+    def close(self):
+        self.db.close()
+
+    def update(self, root, users_root=None, full=False, workers=WORKERS, rescan_days=RESCAN_DAYS):
+        """
+        Bring the index for root up to date, relisting only directories that changed, and return counters for the run.
+        Directories under users_root are attributed to the user named by their first path component under it.
+        """
+        root = os.path.abspath(root)
+        users_root = os.path.abspath(users_root) if users_root else None
+        clause, params = _subtree(root)
+        known, children = {}, {}
+        for path, parent, mtime_ns, scanned in self.db.execute(
+                f'SELECT path, parent, mtime_ns, scanned FROM dirs WHERE {clause}', params):
+            known[path] = (mtime_ns, scanned)
+            children.setdefault(parent, []).append(path)
+
+        # Scan down to users_root on this thread, so that each user's directory and each directory beside them
+        # becomes its own task for the pool
+        scanner = _Scanner(root, users_root, known, children, full, time.time() - rescan_days * 86400)
+        scanner.pending.append((root, False))
+        tasks = []
+        while scanner.pending:
+            path, hidden = scanner.pending.pop()
+            if path == root or (users_root and (path == users_root or users_root.startswith(path + os.sep))):
+                scanner.scan_dir(path, hidden)
+            else: tasks.append((path, hidden))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda task: _Scanner.fork(scanner).scan(*task), tasks))
+
+        # Write the changed directories and forget those that no longer exist
+        with self.db:
+            for result in [scanner] + results:
+                changed = [row[0] for row in result.rows]
+                self.db.executemany('DELETE FROM recent WHERE dir = ?', [(path,) for path in changed])
+                self.db.executemany('INSERT OR REPLACE INTO dirs (path, parent, user, mtime_ns, hidden, bytes, files, '
+                                    'notebooks, scanned) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', result.rows)
+                self.db.executemany('INSERT INTO recent (dir, mtime, notebook) VALUES (?, ?, ?)', result.recent)
+            seen = set().union(scanner.seen, *[result.seen for result in results])
+            removed = [(path,) for path in known if path not in seen]
+            self.db.executemany('DELETE FROM dirs WHERE path = ?', removed)
+            self.db.executemany('DELETE FROM recent WHERE dir = ?', removed)
+            self.db.execute('DELETE FROM recent WHERE mtime < ?', (time.time() - RECENT_DAYS * 86400,))
+
+        counters = {'dirs': len(seen), 'listed': 0, 'unchanged': 0, 'removed': len(removed), 'errors': 0}
+        for result in [scanner] + results:
+            for key in ['listed', 'unchanged', 'errors']: counters[key] += result.counters[key]
+        return counters
+
+    def forget(self, path):
+        """Remove a directory and everything under it from the index, ex: after deleting it"""
+        clause, params = _subtree(path)
+        with self.db:
+            self.db.execute(f'DELETE FROM recent WHERE dir IN (SELECT path FROM dirs WHERE {clause})', params)
+            self.db.execute(f'DELETE FROM dirs WHERE {clause}', params)
+
+    def usage(self, path, since=None):
+        """Return the disk usage and counts of a directory and everything under it"""
+        clause, params = _subtree(path)
+        return self._usage(clause, params, since)
+
+    def user_usage(self, since=None):
+        """Return a dict of user -> disk usage and counts, for every user in the index"""
+        users = [row[0] for row in self.db.execute('SELECT DISTINCT user FROM dirs WHERE user IS NOT NULL')]
+        return {user: self._usage('user = ?', (user,), since) for user in users}
+
+    def _usage(self, clause, params, since):
+        since = since if since is not None else time.time() - 7 * 86400
+        size, files, notebooks = self.db.execute(
+            f'SELECT COALESCE(SUM(bytes), 0), COALESCE(SUM(files), 0), COALESCE(SUM(notebooks), 0) '
+            f'FROM dirs WHERE {clause}', params).fetchone()
+        files_week, notebooks_week = self.db.execute(
+            f'SELECT COUNT(*), COALESCE(SUM(notebook), 0) FROM recent WHERE mtime > ? AND dir IN '
+            f'(SELECT path FROM dirs WHERE {clause})', (since,) + tuple(params)).fetchone()
+        return {'bytes': size, 'files': files, 'notebooks': notebooks, 'files_week': files_week,
+                'notebooks_week': notebooks_week}
+
+
+class _Scanner:
+    """Walks part of the tree for FSIndex.update(), collecting rows to write rather than writing them itself"""
+
+    def __init__(self, root, users_root, known, children, full, rescan_before):
+        self.root = root
+        self.users_root = users_root
+        self.known = known
+        self.children = children
+        self.full = full
+        self.rescan_before = rescan_before
+        self.recent_after = time.time() - RECENT_DAYS * 86400
+        self.rows, self.recent, self.seen, self.pending = [], [], set(), []
+        self.counters = {'listed': 0, 'unchanged': 0, 'errors': 0}
+
+    @staticmethod
+    def fork(scanner):
+        return _Scanner(scanner.root, scanner.users_root, scanner.known, scanner.children, scanner.full,
+                        scanner.rescan_before)
+
+    def scan(self, path, hidden):
+        """Scan a directory and everything under it"""
+        self.pending.append((path, hidden))
+        while self.pending:
+            self.scan_dir(*self.pending.pop())
+        return self
+
+    def user(self, path):
+        if not self.users_root or not path.startswith(self.users_root + os.sep): return None
+        return path[len(self.users_root) + 1:].split(os.sep)[0]
+
+    def scan_dir(self, path, hidden):
+        """Index one directory, queueing its subdirectories"""
+        try: stat = os.stat(path, follow_symlinks=False)
+        except OSError:
+            self.counters['errors'] += 1
+            return
+        self.seen.add(path)
+
+        # Unchanged directories have the same subdirectories, so they don't need to be listed
+        previous = self.known.get(path)
+        if not self.full and previous and previous[0] == stat.st_mtime_ns and previous[1] >= self.rescan_before:
+            self.counters['unchanged'] += 1
+            for child in self.children.get(path, []):
+                self.pending.append((child, hidden or os.path.basename(child).startswith('.')))
+            return
+
+        self.counters['listed'] += 1
+        size, files, notebooks = stat.st_blocks * 512, 0, 0
+        try:
+            with os.scandir(path) as it: entries = list(it)
+        except OSError:
+            self.counters['errors'] += 1
+            entries = []
+        for entry in entries:
+            try:
+                entry_stat = entry.stat(follow_symlinks=False)
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                self.counters['errors'] += 1
+                continue
+            entry_hidden = hidden or entry.name.startswith('.')
+            if is_dir:
+                self.pending.append((entry.path, entry_hidden))
+                continue
+            size += entry_stat.st_blocks * 512
+            if entry.is_file(follow_symlinks=False) and not entry_hidden:
+                notebook = entry.name.endswith('.ipynb')
+                files += 1
+                notebooks += notebook
+                if entry_stat.st_mtime > self.recent_after: self.recent.append((path, entry_stat.st_mtime, notebook))
+        parent = os.path.dirname(path) if path != self.root else None
+        self.rows.append((path, parent, self.user(path), stat.st_mtime_ns, hidden, size, files, notebooks, time.time()))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Maintain and query the filesystem usage index')
+    parser.add_argument('-d', '--database', type=str, default=DB_PATH, help='Path to the index database')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    update = subparsers.add_parser('update', help='Bring the index up to date with the filesystem')
+    update.add_argument('root', type=str, help='Directory to index')
+    update.add_argument('-u', '--users', type=str, default=None, help='Directory whose subdirectories are users')
+    update.add_argument('--full', action='store_true', help='Relist every directory, not only those that changed')
+    update.add_argument('-w', '--workers', type=int, default=WORKERS, help='Number of scanning threads')
+
+    usage = subparsers.add_parser('usage', help='Print the usage of a directory and everything under it')
+    usage.add_argument('path', type=str, help='Directory to report on')
+
+    users = subparsers.add_parser('users', help='Print the usage of each user, largest first')
+    users.add_argument('-n', '--top', type=int, default=None, help='Only print this many users')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    index = FSIndex(args.database)
+    if args.command == 'update':
+        start = time.time()
+        counters = index.update(args.root, args.users, full=args.full, workers=args.workers)
+        print(json.dumps({**counters, 'seconds': round(time.time() - start, 3)}))
+    elif args.command == 'usage':
+        print(json.dumps(index.usage(args.path)))
+    else:
+        user_usage = index.user_usage()
+        for user in sorted(user_usage, key=lambda user: user_usage[user]['bytes'], reverse=True)[:args.top]:
+            print(json.dumps({'user': user, **user_usage[user]}))
+    index.close()
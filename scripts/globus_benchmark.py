@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+
+"""
+Load test and benchmark harness for the Globus transfer service
+
+Runs globus_management.make_app() in a child process against a local stand-in for the slice of the Globus Auth and
+Transfer APIs that the service uses (token introspection, dependent tokens, ACL add/list/delete, transfer submission
+and task status), with configurable latency and failure injection. The Hub is stubbed out as well, so nothing leaves
+the machine. Drives the service with concurrent transfer submissions, waits for the ACL worker to clean up after the
+finished transfers and prints the submission latency, worker sweep times and remote calls per transfer as JSON.
+
+Example, 500 submissions from 50 users against a Globus that takes 100ms per call and fails 1% of the time:
+
+    python globus_benchmark.py --submissions 500 --users 50 --latency 100 --failure-rate 0.01
+"""
+
+from collections import Counter
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+
+
+COLLECTION_ID = 'benchmark-collection'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the g2nb Globus transfer service')
+    parser.add_argument('-c', '--concurrency', type=int, default=50, help='Number of concurrent clients')
+    parser.add_argument('-n', '--submissions', type=int, default=500, help='Number of transfers to submit')
+    parser.add_argument('-u', '--users', type=int, default=20, help='Number of distinct users')
+    parser.add_argument('-p', '--paths', type=int, default=3, help='Number of distinct paths per user')
+    parser.add_argument('-l', '--latency', type=float, default=50, help='Milliseconds taken by each Globus call')
+    parser.add_argument('-j', '--jitter', type=float, default=0.5, help='Random variation of the latency, ex: 0.5 for +/-50%%')
+    parser.add_argument('-f', '--failure-rate', type=float, default=0, help='Fraction of Globus calls that fail')
+    parser.add_argument('-t', '--transfer-seconds', type=float, default=5, help='Seconds each transfer takes to finish')
+    parser.add_argument('--timeout', type=float, default=None, help='Override the service\'s timeout for Globus calls')
+    parser.add_argument('--drain-timeout', type=float, default=300,
+                        help='Seconds to wait for the worker to remove the ACLs once the transfers are done')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Write the JSON results here as well as stdout')
+    return parser.parse_args()
+
+
+class FakeGlobus:
+    """State of the stand-in Globus services, shared by the fake clients in the service process"""
+    latency = 0.05
+    jitter = 0.5
+    failure_rate = 0
+    transfer_seconds = 5
+    lock = threading.Lock()
+    calls = Counter()   # Name of the API call -> number of calls
+    acls = {}           # (principal, path) -> ACL ID
+    tasks = {}          # Task ID -> time the transfer finishes
+
+    MAX_FILTER_TASK_IDS = 50    # Most task IDs the Transfer API accepts in a task_id filter
+    DEFAULT_TASK_LIMIT = 10     # Tasks the Transfer API returns per page when no limit is given
+
+    @staticmethod
+    def call(name):
+        """Count a remote call, then wait and possibly fail as configured"""
+        with FakeGlobus.lock: FakeGlobus.calls[name] += 1
+        time.sleep(max(0, FakeGlobus.latency * (1 + random.uniform(-FakeGlobus.jitter, FakeGlobus.jitter))))
+        if random.random() < FakeGlobus.failure_rate:
+            raise FakeTransferAPIError('ServiceUnavailable', 503)
+
+    @staticmethod
+    def check_task_filter(task_ids):
+        """Reject task ID filters longer than the Transfer API accepts"""
+        if len(task_ids) > FakeGlobus.MAX_FILTER_TASK_IDS:
+            raise FakeTransferAPIError('ClientError.BadRequest', 400)
+
+    @staticmethod
+    def task_page(task_ids, limit):
+        """Return the first page of the filtered task list, as the Transfer API does without paging"""
+        FakeGlobus.check_task_filter(task_ids)
+        tasks = [{'task_id': t, 'status': FakeGlobus.task_status(t)} for t in task_ids if t in FakeGlobus.tasks]
+        return tasks[:limit or FakeGlobus.DEFAULT_TASK_LIMIT]
+
+    @staticmethod
+    def task_status(task_id):
+        finishes = FakeGlobus.tasks.get(task_id)
+        if finishes is None: return None
+        return 'SUCCEEDED' if time.time() >= finishes else 'ACTIVE'
+
+
+class FakeTransferAPIError(Exception):
+    def __init__(self, code, http_status):
+        super().__init__(code)
+        self.code = code
+        self.http_status = http_status
+        self.raw_json = {'code': code}
+
+
+class FakeResponse(dict):
+    @property
+    def data(self): return dict(self)
+
+
+class FakeAuthClient:
+    def __init__(self, client_id=None, client_secret=None): pass
+
+    def oauth2_client_credentials_tokens(self, requested_scopes=None):
+        FakeGlobus.call('oauth2_client_credentials_tokens')
+        return FakeResponse(access_token='app-token', expires_in=172800)
+
+    def oauth2_token_introspect(self, token):
+        FakeGlobus.call('oauth2_token_introspect')
+        return FakeResponse(active=True, exp=time.time() + 3600, username=f'{token}@globusid.org', sub=f'id-{token}')
+
+    def oauth2_get_dependent_tokens(self, token):
+        FakeGlobus.call('oauth2_get_dependent_tokens')
+        return [{'access_token': f'transfer-{token}', 'expires_in': 172800, 'resource_server': 'transfer.api.globus.org'}]
+
+
+class FakeAuthorizer:
+    def __init__(self, access_token): self.access_token = access_token
+
+
+class FakeTransferClient:
+    scopes = types.SimpleNamespace(all='urn:globus:auth:scope:transfer.api.globus.org:all')
+
+    def __init__(self, authorizer=None): self.authorizer = authorizer
+
+    def add_endpoint_acl_rule(self, endpoint_id, rule_data):
+        FakeGlobus.call('add_endpoint_acl_rule')
+        key = (rule_data['principal'], rule_data['path'])
+        with FakeGlobus.lock:
+            if key in FakeGlobus.acls: raise FakeTransferAPIError('Exists', 409)
+            FakeGlobus.acls[key] = f'acl-{len(FakeGlobus.calls)}-{random.getrandbits(32):x}'
+            return FakeResponse(access_id=FakeGlobus.acls[key])
+
+    def endpoint_acl_list(self, endpoint_id):
+        FakeGlobus.call('endpoint_acl_list')
+        with FakeGlobus.lock:
+            return [{'principal': principal, 'path': path, 'id': acl_id, 'principal_type': 'identity'}
+                    for (principal, path), acl_id in FakeGlobus.acls.items()]
+
+    def delete_endpoint_acl_rule(self, endpoint_id, rule_id):
+        FakeGlobus.call('delete_endpoint_acl_rule')
+        with FakeGlobus.lock:
+            for key, acl_id in list(FakeGlobus.acls.items()):
+                if acl_id == rule_id: del FakeGlobus.acls[key]
+        return FakeResponse(code='Deleted')
+
+    def submit_transfer(self, data):
+        FakeGlobus.call('submit_transfer')
+        task_id = f'task-{random.getrandbits(64):x}'
+        with FakeGlobus.lock: FakeGlobus.tasks[task_id] = time.time() + FakeGlobus.transfer_seconds
+        return FakeResponse(task_id=task_id, code='Accepted')
+
+    def get_task(self, task_id):
+        FakeGlobus.call('get_task')
+        return FakeResponse(task_id=task_id, status=FakeGlobus.task_status(task_id))
+
+    def task_list(self, filter=None, limit=None):
+        FakeGlobus.call('task_list')
+        task_ids = filter.split(':', 1)[1].split(',') if filter else list(FakeGlobus.tasks)
+        return FakeGlobus.task_page(task_ids, limit)
+
+    def endpoint_manager_task_list(self, filter_task_id=None, limit=None, **kwargs):
+        FakeGlobus.call('endpoint_manager_task_list')
+        return FakeGlobus.task_page(filter_task_id.split(','), limit)
+
+
+class FakeTransferData(dict):
+    def __init__(self, transfer_client, source_endpoint, destination_endpoint):
+        super().__init__(source_endpoint=source_endpoint, destination_endpoint=destination_endpoint, DATA=[])
+
+    def add_item(self, source_path, destination_path, recursive=False):
+        self['DATA'].append({'source_path': source_path, 'destination_path': destination_path, 'recursive': recursive})
+
+
+def fake_globus_sdk():
+    """Return a stand-in for the globus_sdk module"""
+    module = types.ModuleType('globus_sdk')
+    module.ConfidentialAppAuthClient = FakeAuthClient
+    module.AccessTokenAuthorizer = FakeAuthorizer
+    module.TransferClient = FakeTransferClient
+    module.TransferData = FakeTransferData
+    module.TransferAPIError = FakeTransferAPIError
+    return module
+
+
+def serve(port, db_path, args, ready):
+    """Run the Globus service against the fake Globus in this process, called in the child process"""
+    FakeGlobus.latency = args.latency / 1000
+    FakeGlobus.jitter = args.jitter
+    FakeGlobus.failure_rate = args.failure_rate
+    FakeGlobus.transfer_seconds = args.transfer_seconds
+    sys.modules['globus_sdk'] = fake_globus_sdk()
+    os.environ.update(JUPYTERHUB_API_TOKEN='benchmark', GLOBUS_COLLECTION_ID=COLLECTION_ID, GLOBUS_DB_PATH=db_path)
+
+    import globus_management
+    import logging
+    from tornado.ioloop import IOLoop
+    from tornado.web import RequestHandler
+    if args.timeout: globus_management.GlobusHandler.TIMEOUT = args.timeout
+    logging.getLogger('tornado.access').setLevel(logging.CRITICAL)
+    if args.failure_rate: logging.getLogger('tornado.application').setLevel(logging.CRITICAL)  # Expected errors
+
+    # Stub out the Hub, any token starting with hub- belongs to a user
+    async def user_for_token(token, sync=True, **kwargs):
+        return {'name': token[4:]} if token.startswith('hub-') else None
+    globus_management.hub_auth.user_for_token = user_for_token
+
+    class StatsHandler(RequestHandler):
+        def get(self):
+            with FakeGlobus.lock: calls, acls, tasks = dict(FakeGlobus.calls), len(FakeGlobus.acls), len(FakeGlobus.tasks)
+            self.write({'calls': calls, 'acls': acls, 'tasks': tasks,
+                        'acl_worker': globus_management.acl_manager.stats(),
+                        'token_cache': globus_management.token_cache.stats(),
+                        'transfer_clients': globus_management.transfer_clients.stats()})
+
+    app = globus_management.make_app()
+    app.add_handlers(r'.*', [(r'/benchmark/stats', StatsHandler)])
+    app.listen(port, address='127.0.0.1')
+    ready.set()
+    IOLoop.current().start()
+
+
+def percentile(latencies, p):
+    if not latencies: return None
+    return round(latencies[max(0, math.ceil(p / 100 * len(latencies)) - 1)] * 1000, 3)
+
+
+async def client(base_url, args, queue, results):
+    """Submit transfers from the queue, recording each submission's latency and status code"""
+    http = AsyncHTTPClient()
+    while not queue.empty():
+        n = queue.get_nowait()
+        user = f'user{n % args.users}'
+        path = f'{user}/project{random.randrange(args.paths)}'
+        body = {'globus_token': f'globus-{user}', 'transfer': {
+            'source_endpoint': COLLECTION_ID, 'destination_endpoint': 'destination-endpoint',
+            'DATA': [{'source_path': f'{path}/data{n}.gct', 'destination_path': f'/~/data{n}.gct', 'recursive': False}]}}
+
+        start = time.perf_counter()
+        try:
+            response = await http.fetch(f'{base_url}/services/globus/', method='POST', body=json.dumps(body),
+                                        headers={'Authorization': f'Bearer hub-{user}'}, request_timeout=600)
+            code = response.code
+        except HTTPClientError as e: code = e.code
+        except OSError: code = 'connection_error'
+        results['latencies'].append(time.perf_counter() - start)
+        results['codes'][str(code)] += 1
+
+
+async def get_stats(base_url):
+    response = await AsyncHTTPClient().fetch(f'{base_url}/benchmark/stats')
+    return json.loads(response.body)
+
+
+async def run(base_url, args):
+    results = {'latencies': [], 'codes': Counter()}
+    AsyncHTTPClient.configure(None, max_clients=args.concurrency)
+    queue = asyncio.Queue()
+    for n in range(args.submissions): queue.put_nowait(n)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(base_url, args, queue, results) for i in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    submitted = await get_stats(base_url)
+
+    # Wait for the worker to see the transfers finish and remove their ACLs
+    drain_start = time.perf_counter()
+    while True:
+        stats = await get_stats(base_url)
+        if not stats['acl_worker']['tasks'] or time.perf_counter() - drain_start > args.drain_timeout: break
+        await asyncio.sleep(0.5)
+    drain = time.perf_counter() - drain_start
+
+    latencies = sorted(results['latencies'])
+    succeeded = results['codes'].get('201', 0)
+    return {
+        'concurrency': args.concurrency,
+        'submissions': args.submissions,
+        'users': args.users,
+        'latency_ms': args.latency,
+        'failure_rate': args.failure_rate,
+        'duration': round(elapsed, 3),
+        'throughput': round(len(latencies) / elapsed, 2),
+        'status_codes': dict(results['codes']),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': percentile(latencies, 100),
+        'drain_seconds': round(drain, 3),
+        'acls_left': stats['acls'],
+        'tasks_left': stats['acl_worker']['tasks'],
+        'remote_calls': stats['calls'],
+        'submission_calls_per_transfer': round(sum(submitted['calls'].values()) / succeeded, 3) if succeeded else None,
+        'total_calls_per_transfer': round(sum(stats['calls'].values()) / succeeded, 3) if succeeded else None,
+        'acl_worker': stats['acl_worker'],
+        'token_cache': stats['token_cache'],
+        'transfer_clients': stats['transfer_clients']}
+
+
+def main():
+    args = parse_args()
+
+    # Find a free port for the service
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    temp_dir = tempfile.TemporaryDirectory()
+    db_path = os.path.join(temp_dir.name, 'globus.sqlite')
+    ready = multiprocessing.Event()
+    service = multiprocessing.Process(target=serve, args=(port, db_path, args, ready), daemon=True)
+    service.start()
+    if not ready.wait(timeout=60): sys.exit('Globus service failed to start')
+
+    try: report = asyncio.run(run(f'http://127.0.0.1:{port}', args))
+    finally:
+        service.terminate()
+        service.join()
+        temp_dir.cleanup()
+
+    output = json.dumps(report, indent=4)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f: f.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -31,13 +31,18 @@ c.JupyterHub.services = [
 
 """
 
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from jupyterhub.services.auth import HubOAuthenticated, HubOAuthCallbackHandler, HubAuth
 from tornado.ioloop import IOLoop
 from tornado.web import Application, RequestHandler, authenticated
+import asyncio
+import hashlib
 import logging
 import globus_sdk
 import json
 import os
+import sqlite3
 import threading
 import time
 
@@ -47,6 +52,7 @@ JUPYTERHUB_API_TOKEN = os.getenv("JUPYTERHUB_API_TOKEN")
 COLLECTION_ID = os.getenv("GLOBUS_COLLECTION_ID") or os.getenv("GLOBUS_LOCAL_ENDPOINT")
 CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
+DB_PATH = os.getenv("GLOBUS_DB_PATH", "/data/globus.sqlite")
 
 
 class AuthError(Exception):
@@ -59,11 +65,9 @@ class GlobusUser:
        starting transfers on behalf of users"""
 
     def __init__(self, handler):
-        auth_client = globus_sdk.ConfidentialAppAuthClient(CLIENT_ID, CLIENT_SECRET)
         self.handler = handler
         self.token = self.get_token()
-        self.introspection_data = self.introspect(auth_client, self.token)
-        self.dependent_tokens = auth_client.oauth2_get_dependent_tokens(self.token)
+        self.introspection_data, self.dependent_tokens, self.tokens_received = token_cache.get(self.token)
 
     @property
     def username(self): return self.introspection_data["username"]
@@ -93,28 +97,247 @@ class GlobusUser:
         if expires_in < 0: raise AuthError("Globus token has expired")
         return introspection.data
 
+    @staticmethod
+    def authorize(token):
+        """Introspect the token and exchange it for dependent tokens, return both and the time they were received"""
+        auth_client = globus_sdk.ConfidentialAppAuthClient(CLIENT_ID, CLIENT_SECRET)
+        introspection_data = GlobusUser.introspect(auth_client, token)
+        dependent_tokens = auth_client.oauth2_get_dependent_tokens(token)
+        return introspection_data, dependent_tokens, time.time()
+
+    @property
+    def transfer_token_expires(self):
+        """Time when the user's transfer token expires"""
+        return self.tokens_received + self.dependent_tokens[0]["expires_in"]
+
     def get_transfer_client(self):
-        authorizer = globus_sdk.AccessTokenAuthorizer(self.dependent_tokens[0]["access_token"])
-        return globus_sdk.TransferClient(authorizer=authorizer)
+        return transfer_clients.user_client(self.id, self.dependent_tokens[0]["access_token"], self.transfer_token_expires)
+
+
+class GlobusTokenCache:
+    """Remembers the introspection and dependent tokens of recently seen Globus tokens, so that a user submitting
+       several transfers in a row is only authorized with Globus once
+
+       Entries are keyed by a hash of the token and expire with the token, or after MAX_TTL so that a revoked
+       token is not honored for long. Concurrent requests with the same token share one authorization."""
+
+    MAX_ENTRIES = 1024      # Number of tokens to remember
+    MAX_TTL = 600           # Longest time in seconds to trust an introspection
+    EXPIRY_MARGIN = 60      # Seconds before a token expires that it is no longer used
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # Hash of the token -> (expiry time, (introspection, dependent tokens, time))
+        self.pending = {}               # Hash of the token -> Future of an authorization in progress
+        self.counters = {"hits": 0, "shared": 0, "misses": 0, "errors": 0}
+
+    def get(self, token):
+        """Return the token's introspection data, dependent tokens and the time they were received,
+           raise AuthError if the token isn't valid"""
+        key = hashlib.sha256(token.encode("UTF-8")).hexdigest()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return entry[1]
+            future = self.pending.get(key)
+            owner = future is None
+            if owner:
+                future = self.pending[key] = Future()
+                self.counters["misses"] += 1
+            else: self.counters["shared"] += 1
+        if not owner: return future.result()
+
+        try:
+            result = GlobusUser.authorize(token)
+            future.set_result(result)
+        except Exception as e:
+            self.counters["errors"] += 1  # Failures are not cached
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock: del self.pending[key]
+
+        # Expire with the first of the token and the transfer token to expire
+        introspection_data, dependent_tokens, received = result
+        expires = min(introspection_data["exp"], received + dependent_tokens[0]["expires_in"],
+                      received + GlobusTokenCache.MAX_TTL) - GlobusTokenCache.EXPIRY_MARGIN
+        with self.lock:
+            self.entries[key] = (expires, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > GlobusTokenCache.MAX_ENTRIES: self.entries.popitem(last=False)
+        return result
+
+    def stats(self):
+        lookups = self.counters["hits"] + self.counters["shared"] + self.counters["misses"]
+        hit_rate = round((self.counters["hits"] + self.counters["shared"]) / lookups, 4) if lookups else None
+        return {**self.counters, "entries": len(self.entries), "pending": len(self.pending), "hit_rate": hit_rate}
+
+
+class TransferClientCache:
+    """Reuses Globus transfer clients for as long as their access tokens are valid, rather than making a new
+       client (and for the app, a new client credentials grant) every time one is needed"""
+
+    REFRESH_MARGIN = 300    # Seconds before a token expires that it is replaced
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.app = None             # The app's own client
+        self.app_expires = 0        # Time when the app's token expires
+        self.users = {}             # Identity ID -> (access token, expiry time, client)
+        self.counters = {"app_hits": 0, "app_refreshes": 0, "user_hits": 0, "user_misses": 0}
+
+    def app_client(self):
+        """Return the app's transfer client, getting a new token if the current one is close to expiring"""
+        app = self.app  # Read once, as invalidate_app_client() may clear it from another thread
+        if app is not None and time.time() < self.app_expires - TransferClientCache.REFRESH_MARGIN:
+            self.counters["app_hits"] += 1
+            return app
+        with self.lock:  # Only one thread refreshes, the others wait for it and then use the new client
+            if self.app is None or time.time() >= self.app_expires - TransferClientCache.REFRESH_MARGIN:
+                auth_client = globus_sdk.ConfidentialAppAuthClient(CLIENT_ID, CLIENT_SECRET)
+                tokens = auth_client.oauth2_client_credentials_tokens(
+                    requested_scopes=globus_sdk.TransferClient.scopes.all).data
+                authorizer = globus_sdk.AccessTokenAuthorizer(tokens["access_token"])
+                self.app = globus_sdk.TransferClient(authorizer=authorizer)
+                self.app_expires = time.time() + tokens["expires_in"]
+                self.counters["app_refreshes"] += 1
+            else: self.counters["app_hits"] += 1
+            return self.app
+
+    def user_client(self, identity_id, access_token, expires):
+        """Return a transfer client for the user's access token, reusing the client made for the same token
+
+           Raises AuthError if the token has expired, as Globus would reject every call made with it."""
+        with self.lock:
+            # Forget clients whose tokens have expired
+            now = time.time()
+            for expired in [k for k, (token, expiry, client) in self.users.items() if expiry <= now]: del self.users[expired]
+            if expires <= now: raise AuthError("Globus transfer token has expired")
+
+            entry = self.users.get(identity_id)
+            if entry is not None and entry[0] == access_token:
+                self.counters["user_hits"] += 1
+                return entry[2]
+            client = globus_sdk.TransferClient(authorizer=globus_sdk.AccessTokenAuthorizer(access_token))
+            self.users[identity_id] = (access_token, expires, client)
+            self.counters["user_misses"] += 1
+            return client
+
+    def invalidate_app_client(self):
+        """Drop the app's client, ex: after its token is rejected"""
+        with self.lock: self.app = None
+
+    def stats(self):
+        return {**self.counters, "users": len(self.users), "app_expires_in": max(0, round(self.app_expires - time.time()))}
+
+
+class ACLIndex:
+    """Local SQLite copy of the collection's ACLs, keyed by (principal, path), and of the transfers being tracked
+
+       Lets set_user_acl() find an existing ACL without listing every ACL on the collection, and lets tracked
+       transfers survive a restart of the service. Reconciled with the collection's ACL list in the background."""
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS acls (principal TEXT NOT NULL, path TEXT NOT NULL, "
+                            "acl_id TEXT NOT NULL, PRIMARY KEY (principal, path))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS ix_acls_acl_id ON acls (acl_id)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS tasks (task_id TEXT PRIMARY KEY, principal TEXT NOT NULL, "
+                            "path TEXT NOT NULL, acl_id TEXT NOT NULL, created REAL NOT NULL)")
+
+    def get(self, principal, path):
+        """Return the ID of the principal's ACL for the path, or None if it isn't known"""
+        with self.lock:
+            row = self.db.execute("SELECT acl_id FROM acls WHERE principal = ? AND path = ?", (principal, path)).fetchone()
+        return row[0] if row else None
+
+    def put(self, principal, path, acl_id):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO acls (principal, path, acl_id) VALUES (?, ?, ?)",
+                            (principal, path, acl_id))
+
+    def remove(self, acl_id):
+        """Forget a deleted ACL and any transfers tracked against it"""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM acls WHERE acl_id = ?", (acl_id,))
+            self.db.execute("DELETE FROM tasks WHERE acl_id = ?", (acl_id,))
+
+    def replace(self, acls):
+        """Replace the index with a fresh list of (principal, path, acl_id)"""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM acls")
+            self.db.executemany("INSERT OR REPLACE INTO acls (principal, path, acl_id) VALUES (?, ?, ?)", acls)
+
+    def add_task(self, task_id, principal, path, acl_id, created):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO tasks (task_id, principal, path, acl_id, created) "
+                            "VALUES (?, ?, ?, ?, ?)", (task_id, principal, path, acl_id, created))
+
+    def remove_task(self, task_id):
+        with self.lock, self.db: self.db.execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
+
+    def tasks(self):
+        """Return the tracked transfers as a list of (task_id, principal, path, acl_id, created)"""
+        with self.lock: return self.db.execute("SELECT task_id, principal, path, acl_id, created FROM tasks").fetchall()
 
 
 class ACLManager:
     """Provides a service for setting ACLs and tracking them throughout the life
     of the Globus transfer"""
     cache = {}
+    lock = threading.Lock()     # Guards the cache, which is shared by the request handlers and the worker thread
+
+    SWEEP_INTERVAL = 1          # Seconds between sweeps of the tracked transfers
+    MIN_POLL_INTERVAL = 1       # Seconds before a new transfer's status is first checked
+    MAX_POLL_INTERVAL = 60      # Longest time between checks of a long-running transfer
+    BACKOFF = 2                 # Multiplier applied to the polling interval each time a transfer is still running
+    MAX_TASKS_PER_REQUEST = 50  # Task IDs looked up in one request, the most the Transfer API's task_id filter accepts
+    MAX_TASK_AGE = 7 * 86400    # Seconds after which a task whose status can't be found is assumed to be finished
+    RECONCILE_INTERVAL = 3600   # Seconds between refreshes of the ACL index from the collection
+    FINISHED = {"SUCCEEDED", "FAILED"}
+
+    metrics = {
+        "sweeps": 0,
+        "last_sweep_ms": 0,
+        "max_sweep_ms": 0,
+        "status_requests": 0,
+        "statuses_checked": 0,
+        "tasks_finished": 0,
+        "acls_deleted": 0,
+        "index_hits": 0,
+        "index_misses": 0,
+        "reconciles": 0,
+        "restored_tasks": 0,
+        "errors": 0,
+    }
 
     def __init__(self):
         self.transfer_client = ACLManager.get_app_transfer_client()
+        ACLManager.restore()
         threading.Thread(target=self.worker, daemon=True).start()
 
+    @staticmethod
+    def restore():
+        """Resume tracking the transfers saved before a restart
+
+           The users' tokens aren't saved, so these are checked with the app's endpoint manager role until the user
+           makes another transfer request."""
+        with ACLManager.lock:
+            for task_id, principal, path, acl_id, created in acl_index.tasks():
+                data = ACLManager.cache.setdefault(principal, {"user": None, "paths": {}})
+                if path not in data["paths"]: data["paths"][path] = ACLManager.ACLGroup(acl_id, path, [])
+                data["paths"][path].add_task(task_id, created)
+                ACLManager.metrics["restored_tasks"] += 1
+
     @staticmethod
     def get_app_transfer_client():
-        """Authorize and return a Globus transfer client"""
-        auth_client = globus_sdk.ConfidentialAppAuthClient(CLIENT_ID, CLIENT_SECRET)
-        tokens = auth_client.oauth2_client_credentials_tokens(
-            requested_scopes=globus_sdk.TransferClient.scopes.all).data
-        authorizer = globus_sdk.AccessTokenAuthorizer(tokens["access_token"])
-        return globus_sdk.TransferClient(authorizer=authorizer)
+        """Return the app's Globus transfer client, authorizing it if needed"""
+        return transfer_clients.app_client()
 
     class ACLGroup:
         """Helper class to track ACLs according to user transfers."""
@@ -122,48 +345,149 @@ class ACLManager:
         def __init__(self, acl_id, path, tasks):
             self.acl_id = acl_id
             self.path = path
-            self.tasks = tasks
-
-        def check_transfers(self, transfer_client):
-            for task in self.tasks:
-                if transfer_client.get_task(task)["status"] in ["SUCCEEDED", "FAILED"]:
-                    self.tasks.remove(task)
+            self.tasks = {}  # Task ID -> (time of the next status check, seconds between checks)
+            self.created = {}  # Task ID -> time the transfer was submitted
+            for task in tasks: self.add_task(task)
+
+        def add_task(self, task_id, created=None):
+            self.tasks[task_id] = (time.monotonic() + ACLManager.MIN_POLL_INTERVAL, ACLManager.MIN_POLL_INTERVAL)
+            self.created[task_id] = created or time.time()
+
+        def due_tasks(self, now):
+            """Return the IDs of the tasks whose status should be checked now"""
+            return [task_id for task_id, (next_check, interval) in list(self.tasks.items()) if next_check <= now]
+
+        def check_transfers(self, statuses, due, now):
+            """Stop tracking finished tasks, and back off checking on those still running"""
+            for task_id in due:
+                if task_id not in self.tasks: continue
+                status = statuses.get(task_id)
+                expired = status is None and time.time() - self.created[task_id] > ACLManager.MAX_TASK_AGE
+                if status in ACLManager.FINISHED or expired:
+                    del self.tasks[task_id]
+                    del self.created[task_id]
+                    acl_index.remove_task(task_id)
+                    ACLManager.metrics["tasks_finished"] += 1
+                else:
+                    interval = min(self.tasks[task_id][1] * ACLManager.BACKOFF, ACLManager.MAX_POLL_INTERVAL)
+                    self.tasks[task_id] = (now + interval, interval)
 
     @staticmethod
     def worker():
         """Worker thread for tracking Globus transfers"""
+        last_reconcile = None
         while True:
-            for uid, data in ACLManager.cache.items():
-                user = data["user"]
-                user_tc = user.get_transfer_client()
-                for path in list(data["paths"]):
-                    acl_obj = data["paths"][path]
-                    acl_obj.check_transfers(user_tc)
-                    if not acl_obj.tasks:
-                        app_tc = ACLManager.get_app_transfer_client()
-                        app_tc.delete_endpoint_acl_rule(COLLECTION_ID, acl_obj.acl_id)
-                        del data["paths"][path]
-
-            for uid in list(ACLManager.cache):
-                if not ACLManager.cache[uid]["paths"]:
-                    del ACLManager.cache[uid]
-
-            time.sleep(1)
+            start = time.monotonic()
+            if last_reconcile is None or start - last_reconcile > ACLManager.RECONCILE_INTERVAL:
+                try: ACLManager.reconcile()
+                except Exception:
+                    ACLManager.metrics["errors"] += 1
+                    logging.exception('Error refreshing the ACL index')
+                last_reconcile = start
+
+            with ACLManager.lock: users = list(ACLManager.cache.items())
+            for uid, data in users:
+                try: ACLManager.sweep_user(data)
+                except Exception:
+                    ACLManager.metrics["errors"] += 1
+                    logging.exception(f'Error checking transfers for {uid}')
+
+            with ACLManager.lock:
+                for uid in list(ACLManager.cache):
+                    if not ACLManager.cache[uid]["paths"]:
+                        del ACLManager.cache[uid]
+
+            elapsed = time.monotonic() - start
+            ACLManager.metrics["sweeps"] += 1
+            ACLManager.metrics["last_sweep_ms"] = round(elapsed * 1000, 3)
+            ACLManager.metrics["max_sweep_ms"] = max(ACLManager.metrics["max_sweep_ms"], round(elapsed * 1000, 3))
+            time.sleep(max(0, ACLManager.SWEEP_INTERVAL - elapsed))
+
+    @staticmethod
+    def sweep_user(data):
+        """Check the status of all the user's due tasks in bulk, and delete the ACLs no longer in use"""
+        now = time.monotonic()
+        with ACLManager.lock: groups = list(data["paths"].values())
+        due = {acl_obj: acl_obj.due_tasks(now) for acl_obj in groups}
+        task_ids = [task_id for tasks in due.values() for task_id in tasks]
+        if not task_ids: return
+        # Without a valid user token (after a restart, or once it expires during a long transfer) fall back to the
+        # app's manager role, so the tasks still finish or expire after MAX_TASK_AGE rather than failing every sweep
+        user = data["user"]
+        if user is not None and user.transfer_token_expires > time.time():
+            statuses = ACLManager.get_task_statuses(user.get_transfer_client(), task_ids)
+        else: statuses = ACLManager.get_managed_task_statuses(task_ids)
+
+        for acl_obj, tasks in due.items():
+            with ACLManager.lock:
+                acl_obj.check_transfers(statuses, tasks, now)
+                if acl_obj.tasks: continue
+                del data["paths"][acl_obj.path]
+            app_tc = ACLManager.get_app_transfer_client()
+            app_tc.delete_endpoint_acl_rule(COLLECTION_ID, acl_obj.acl_id)
+            acl_index.remove(acl_obj.acl_id)
+            ACLManager.metrics["acls_deleted"] += 1
+
+    @staticmethod
+    def get_task_statuses(transfer_client, task_ids):
+        """Look up the status of many tasks with as few task_list() requests as possible, return a dict of ID -> status"""
+        statuses = {}
+        for i in range(0, len(task_ids), ACLManager.MAX_TASKS_PER_REQUEST):
+            batch = task_ids[i:i + ACLManager.MAX_TASKS_PER_REQUEST]
+            response = transfer_client.task_list(filter=f'task_id:{",".join(batch)}', limit=len(batch))
+            ACLManager.metrics["status_requests"] += 1
+            for task in response: statuses[task["task_id"]] = task["status"]
+        ACLManager.metrics["statuses_checked"] += len(task_ids)
+        return statuses
+
+    @staticmethod
+    def get_managed_task_statuses(task_ids):
+        """Look up task statuses as the collection's manager, used for transfers restored after a restart
+
+           Returns no statuses if the app doesn't have a manager role, leaving the tasks to expire after MAX_TASK_AGE."""
+        app_tc = ACLManager.get_app_transfer_client()
+        statuses = {}
+        try:
+            for i in range(0, len(task_ids), ACLManager.MAX_TASKS_PER_REQUEST):
+                batch = task_ids[i:i + ACLManager.MAX_TASKS_PER_REQUEST]
+                response = app_tc.endpoint_manager_task_list(filter_task_id=",".join(batch), limit=len(batch))
+                ACLManager.metrics["status_requests"] += 1
+                for task in response: statuses[task["task_id"]] = task["status"]
+        except globus_sdk.TransferAPIError as tapie:
+            logging.warning(f'Unable to check restored transfers as collection manager: {tapie.code}')
+        ACLManager.metrics["statuses_checked"] += len(task_ids)
+        return statuses
+
+    @staticmethod
+    def reconcile():
+        """Refresh the ACL index from the collection's full list of ACLs"""
+        app_tc = ACLManager.get_app_transfer_client()
+        acl_index.replace([(acl["principal"], acl["path"], acl["id"]) for acl in app_tc.endpoint_acl_list(COLLECTION_ID)
+                           if acl["principal_type"] == "identity"])
+        ACLManager.metrics["reconciles"] += 1
 
     def track_acl(self, user, transfer_task_id, path, acl_id):
-        """Track the ACL"""
-        if not ACLManager.cache.get(user.id):
-            ACLManager.cache[user.id] = {
-                "user": user,
-                "paths": {},
-            }
-        if ACLManager.cache[user.id]["paths"].get(path):
-            ACLManager.cache[user.id]["paths"][path].tasks.append(transfer_task_id)
-        else:
-            ACLManager.cache[user.id] = {
-                "user": user,
-                "paths": {path: self.ACLGroup(acl_id, path, [transfer_task_id])},
-            }
+        """Track the ACL, saving the transfer to the index so blocks on SQLite and should be run on an executor"""
+        acl_index.add_task(transfer_task_id, user.id, path, acl_id, time.time())
+        with ACLManager.lock:
+            if not ACLManager.cache.get(user.id):
+                ACLManager.cache[user.id] = {
+                    "user": user,
+                    "paths": {},
+                }
+            ACLManager.cache[user.id]["user"] = user  # Use the most recent tokens to check on transfers
+            if ACLManager.cache[user.id]["paths"].get(path):
+                ACLManager.cache[user.id]["paths"][path].add_task(transfer_task_id)
+            else:
+                ACLManager.cache[user.id]["paths"][path] = self.ACLGroup(acl_id, path, [transfer_task_id])
+
+    @staticmethod
+    def stats():
+        """Return the worker's metrics and the number of transfers being tracked"""
+        with ACLManager.lock:
+            groups = [acl_obj for data in ACLManager.cache.values() for acl_obj in data["paths"].values()]
+        return {**ACLManager.metrics, "users": len(ACLManager.cache), "acls": len(groups),
+                "tasks": sum(len(acl_obj.tasks) for acl_obj in groups)}
 
     @staticmethod
     def get_acl_path(transfer_doc):
@@ -192,18 +516,33 @@ class ACLManager:
                     "permissions": "rw",
                 },
             )
+            acl_index.put(globus_user.id, acl_path, response["access_id"])
             return response["access_id"]
         except globus_sdk.TransferAPIError as tapie:
             if tapie.code == "Exists":
-                for acl in app_tc.endpoint_acl_list(COLLECTION_ID):
-                    if acl["path"] == acl_path and acl["principal"] == globus_user.id: return acl["id"]
-            else: raise Exception(f"Unknown error for {globus_user.username}")
+                acl_id = acl_index.get(globus_user.id, acl_path)
+                if acl_id is not None:
+                    ACLManager.metrics["index_hits"] += 1
+                    return acl_id
+
+                # Not in the index, so it was made elsewhere, refresh the index from the collection
+                ACLManager.metrics["index_misses"] += 1
+                ACLManager.reconcile()
+                acl_id = acl_index.get(globus_user.id, acl_path)
+                if acl_id is not None: return acl_id
+            else:
+                if tapie.http_status == 401: transfer_clients.invalidate_app_client()  # Get a new token next time
+                raise Exception(f"Unknown error for {globus_user.username}")
         raise Exception(f"Unable to make/find ACL for user {globus_user.username} at {acl_path}")
 
 
 class GlobusHandler(HubOAuthenticated, RequestHandler):
     """Endpoint for submitting Globus transfer requests and handling ACL management"""
 
+    # Calls to Globus block, so they run on these threads rather than holding up the IOLoop
+    executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='globus')
+    TIMEOUT = 30    # Seconds to wait for each call to Globus
+
     def set_default_headers(self):
         """Handle CORS requests"""
         self.set_header("Access-Control-Allow-Origin", "*")
@@ -222,16 +561,27 @@ class GlobusHandler(HubOAuthenticated, RequestHandler):
         except json.JSONDecodeError: self.json_data = None
         except TypeError: self.json_data = None
 
-    def get_globus_user(self):
+    async def get_globus_user(self):
         try:
             token = self.request.headers["Authorization"].split()[1]
-            hub_user = hub_auth.user_for_token(token)
+            hub_user = await hub_auth.user_for_token(token, sync=False)
             if hub_user is None: raise AuthError('Unable to validate hub user')
-            return GlobusUser(self)
-        except AuthError as exc:
+            return await self.call_globus(GlobusUser, self)
+        except (AuthError, KeyError, IndexError) as exc:
             self.send_error(401, reason='Failed to authorize')
             return None
 
+    @staticmethod
+    async def call_globus(func, *args, on_timeout=None):
+        """Run a blocking Globus call on the executor, raise asyncio.TimeoutError if it takes over TIMEOUT seconds
+
+           A call that times out keeps running on its thread, on_timeout is called with its future when it finishes."""
+        future = IOLoop.current().run_in_executor(GlobusHandler.executor, func, *args)
+        try: return await asyncio.wait_for(asyncio.shield(future), timeout=GlobusHandler.TIMEOUT)
+        except asyncio.TimeoutError:
+            if on_timeout: future.add_done_callback(on_timeout)
+            raise
+
     @staticmethod
     def do_transfer(user, transfer_document):
         """Do the actual user transfer and return the transfer response."""
@@ -252,35 +602,60 @@ class GlobusHandler(HubOAuthenticated, RequestHandler):
             "service": "Globus Service",
             "description": "This service allows transferring data to a shared Globus collection",
             "collection": COLLECTION_ID,
-            "hub_user": self.get_current_user()
+            "hub_user": self.get_current_user(),
+            "acl_worker": acl_manager.stats(),
+            "transfer_clients": transfer_clients.stats(),
+            "token_cache": token_cache.stats()
         })
         self.finish()
 
-    def post(self):
+    async def post(self):
         """Accept a post request from globus-jupyterlab.
            Sets ACLs and initiates the transfer."""
 
         # Obtain the globus user and the transfer doc
-        globus_user = self.get_globus_user()
-        transfer_doc = self.json_data["transfer"]
+        try: globus_user = await self.get_globus_user()
+        except asyncio.TimeoutError:
+            self.send_error(504, reason="Timed out authorizing with Globus")
+            return
+        if globus_user is None: return
+
+        def track_late_transfer(future):
+            # A transfer that timed out may still have been submitted, make sure its ACL is eventually removed
+            if not future.cancelled() and future.exception() is None:
+                GlobusHandler.executor.submit(acl_manager.track_acl, globus_user, future.result()["task_id"],
+                                              acl_path, acl_id)
 
         # Set the ACL and initiate the transfer
         try:
+            transfer_doc = self.json_data["transfer"]
             acl_path = acl_manager.get_acl_path(transfer_doc)                           # Get the path to set
-            acl_id = acl_manager.set_user_acl(globus_user, acl_path)                    # Set the ACL
-            response = self.do_transfer(globus_user, transfer_doc)                      # Start the transfer
-            acl_manager.track_acl(globus_user, response["task_id"], acl_path, acl_id)   # Track the transfer
+            acl_id = await self.call_globus(acl_manager.set_user_acl, globus_user, acl_path)            # Set the ACL
+            response = await self.call_globus(self.do_transfer, globus_user, transfer_doc,
+                                              on_timeout=track_late_transfer)           # Start the transfer
+            await IOLoop.current().run_in_executor(GlobusHandler.executor, acl_manager.track_acl,
+                                                   globus_user, response["task_id"], acl_path, acl_id)  # Track it
             self.set_status(201)
             self.write(response)
-        except KeyError:
+        except (KeyError, TypeError, ValueError):
             self.send_error(400, reason="Invalid Transfer Document")
+            return
         except globus_sdk.TransferAPIError as tapie:
-            self.send_error(tapie.http_status, reason=tapie.raw_json)
+            # Pass Globus' error document on to the client, raw_json is a dict and so can't be the reason phrase
+            self.set_status(tapie.http_status)
+            self.finish(tapie.raw_json or {"code": tapie.code})
+            return
+        except asyncio.TimeoutError:
+            self.send_error(504, reason="Timed out waiting for Globus")
+            return
         self.finish()
 
 
 # Create manager singletons
 hub_auth = HubAuth(api_token=JUPYTERHUB_API_TOKEN, cache_max_age=60)
+token_cache = GlobusTokenCache()
+transfer_clients = TransferClientCache()
+acl_index = ACLIndex(DB_PATH)
 acl_manager = ACLManager()
 
 
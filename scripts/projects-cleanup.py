@@ -14,6 +14,8 @@ import shutil
 parser = argparse.ArgumentParser(description='Cleanup old project directories the notebook workspace')
 parser.add_argument('-u', '--userdir', type=str, default='/data/users/', help='Path to the users directory')
 parser.add_argument('-d', '--database', type=str, default='/data/jupyterhub.sqlite', help='Path to JupyterHub database')
+parser.add_argument('-i', '--index', type=str, default=None, help='Path to the fs_index.py database, to report and '
+                                                                   'forget the size of removed projects')
 
 # Parse the arguments
 args = parser.parse_args()
@@ -42,6 +44,13 @@ try:
 except sqlite3.Error as e:
     print(e)
 
+# Open the filesystem index, if one was given
+index = None
+if args.index:
+    import fs_index
+    index = fs_index.FSIndex(args.index)
+freed = 0
+
 # Get a list of all users
 cur = db.cursor()
 cur.execute('SELECT * FROM users')
@@ -73,8 +82,16 @@ for user in users:
 
         # If the directory doesn't have a project in the database
         if p not in projects:
-            print(f'REMOVING {project_path}')
+            if index:
+                usage = index.usage(project_path)
+                freed += usage['bytes']
+                print(f'REMOVING {project_path} ({usage["bytes"]} bytes, {usage["files"]} files)')
+            else: print(f'REMOVING {project_path}')
             shutil.rmtree(project_path)
+            if index: index.forget(project_path)
 
 # Close the connection to the database
 db.close()
+if index:
+    print(f'FREED {freed} bytes')
+    index.close()
@@ -6,12 +6,16 @@ import sys
 import shutil
 import base64
 import json
+import math
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import urllib.request
 from datetime import datetime, timedelta, date
-from sqlalchemy import Column, Integer, String, DateTime, create_engine
+from sqlalchemy import Column, Integer, String, DateTime, bindparam, create_engine, inspect, text
 from sqlalchemy.orm import declarative_base, sessionmaker
 from urllib.parse import urlparse
 
@@ -29,6 +33,10 @@ DB_PATH = '//data/lab/usage.sqlite'   # Path to usage events database
 MAIL_SERVER = 'smtp-server-url'       # URL pointing at the SMTP server
 MAIL_USERNAME = 'username'            # Username for SMTP server, leave None if N/A
 MAIL_PASSWORD = 'password'            # Password for SMTP server
+SCAN_WORKERS = 16                     # Threads used to scan user directories in parallel
+FS_INDEX_PATH = None                  # Incremental index updated by fs_index.py, ex: '/data/lab/fs_index.sqlite'
+                                      # Faster than walking the tree, but counts hard links once per directory and
+                                      # can miss files rewritten in place until fs_index.RESCAN_DAYS
 
 
 # Handle arguments
@@ -165,31 +173,134 @@ def get_weekly_jobs():
     return weekly_jobs
 
 
-def get_user_disk():
+_file_scan = None
+_seen_inodes = set()
+_seen_lock = threading.Lock()
+
+
+def _empty_counts():
+    return {'bytes': 0, 'files': 0, 'notebooks': 0, 'files_week': 0, 'notebooks_week': 0, 'errors': 0}
+
+
+def _scan_tree(path, week_ago, skip=(), hidden=False):
     """
-    Handle determining disk usage on this VM
+    Walk a directory tree with os.scandir, returning its disk usage (like du, including hidden files)
+    and its counts of files and notebooks (like find -not -path '*/.*', excluding hidden files)
     """
-    users = []
+    counts = _empty_counts()
+    try: counts['bytes'] += os.stat(path, follow_symlinks=False).st_blocks * 512
+    except OSError: counts['errors'] += 1
+    stack = [(path, hidden)]
+    while stack:
+        current, hidden = stack.pop()
+        try:
+            with os.scandir(current) as it: entries = list(it)
+        except OSError:
+            counts['errors'] += 1
+            continue
+
+        for entry in entries:
+            if entry.path in skip: continue
+            try: stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                counts['errors'] += 1
+                continue
+            is_dir = entry.is_dir(follow_symlinks=False)
+            entry_hidden = hidden or entry.name.startswith('.')
+
+            # Count the disk used by hard linked files only once, as du does
+            counted = False
+            if stat.st_nlink > 1 and not is_dir:
+                with _seen_lock:
+                    counted = (stat.st_dev, stat.st_ino) in _seen_inodes
+                    _seen_inodes.add((stat.st_dev, stat.st_ino))
+            if not counted: counts['bytes'] += stat.st_blocks * 512
+
+            if is_dir: stack.append((entry.path, entry_hidden))
+            elif entry.is_file(follow_symlinks=False) and not entry_hidden:
+                notebook = entry.name.endswith('.ipynb')
+                recent = stat.st_mtime > week_ago
+                counts['files'] += 1
+                counts['notebooks'] += notebook
+                counts['files_week'] += recent
+                counts['notebooks_week'] += notebook and recent
+    return counts
+
+
+def scan_files():
+    """
+    Walk data_dir in a single pass, scanning user directories in parallel,
+    return the file counts for the whole tree and the counts and disk usage of each user
+    """
+    global _file_scan
+    if _file_scan is not None: return _file_scan
+    if FS_INDEX_PATH:
+        _file_scan = _index_scan()
+        return _file_scan
+
+    week_ago = time.time() - 7 * 24 * 60 * 60
+    users_root = os.path.normpath(user_dir)
+    in_data_dir = os.path.commonpath([os.path.normpath(data_dir), users_root]) == os.path.normpath(data_dir)
+    try:
+        with os.scandir(users_root) as it: users = {e.name: e.path for e in it if e.is_dir(follow_symlinks=False)}
+    except OSError: users = {}
 
-    if not test_run:
-        # Get the amount of disk usage per user
+    # Scan each user directory as its own task, and the rest of data_dir around them
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        user_scans = {name: executor.submit(_scan_tree, path, week_ago, (), name.startswith('.'))
+                      for name, path in users.items()}
+        rest = executor.submit(_scan_tree, os.path.normpath(data_dir), week_ago, set(users.values()))
+        _file_scan = {'users': {name: scan.result() for name, scan in user_scans.items()}, 'total': rest.result()}
 
-        cmd_out = subprocess.getstatusoutput(sudo_req + 'du -h --max-depth=1 ' + user_dir + ' | sort -hr')[1]
-        cmd_lines = cmd_out.split('\n')
+    # Add the user directories to the totals for data_dir, as find would have counted them
+    if in_data_dir:
+        for counts in _file_scan['users'].values():
+            for key, value in counts.items(): _file_scan['total'][key] += value
+    return _file_scan
 
-        # Iterate over each user's line
-        for line in cmd_lines:
-            cmd_parts = line.split('\t')
 
-            # Clean the username
-            cleaned_name = cmd_parts[1][len(data_dir):]
+def _index_scan():
+    """
+    Bring the filesystem index up to date, relisting only directories that changed since the last run,
+    and return the same counts as the full scan in scan_files()
+    """
+    import fs_index  # Only needed when FS_INDEX_PATH is set, so fs_index.py needn't be deployed alongside otherwise
+    index = fs_index.FSIndex(FS_INDEX_PATH)
+    try:
+        counters = index.update(data_dir, user_dir, workers=SCAN_WORKERS)
+        users_root, root = os.path.normpath(user_dir), os.path.normpath(data_dir)
+        if os.path.commonpath([root, users_root]) != root:
+            errors = counters['errors'] + index.update(user_dir, user_dir, workers=SCAN_WORKERS)['errors']
+        else: errors = counters['errors']
+        week_ago = time.time() - 7 * 24 * 60 * 60
+        users = {name: {**counts, 'errors': 0} for name, counts in index.user_usage(since=week_ago).items()}
+        return {'users': users, 'total': {**index.usage(data_dir, since=week_ago), 'errors': errors}}
+    finally: index.close()
+
+
+def _human_size(size):
+    """
+    Format a number of bytes the way du -h does, ex: 4.0K, 12K, 1.5G
+    """
+    for unit in ['', 'K', 'M', 'G', 'T', 'P']:
+        if size < 1024 or unit == 'P': break
+        size /= 1024
+    if unit == '': return str(int(size))
+    return f'{math.ceil(size * 10) / 10:.1f}{unit}' if size < 10 else f'{math.ceil(size)}{unit}'
 
-            # Ignore the base directory
-            if cleaned_name == '':
-                continue
 
-            # Add the user stats to the list
-            users.append([cmd_parts[0], cleaned_name])
+def get_user_disk():
+    """
+    Handle determining disk usage on this VM
+    """
+    users = []
+
+    if not test_run:
+        # Get the amount of disk usage per user, largest first
+        user_scans = scan_files()['users']
+        for name in sorted(user_scans, key=lambda name: user_scans[name]['bytes'], reverse=True):
+            cleaned_name = os.path.join(user_dir, name)[len(data_dir):]
+            users.append([_human_size(user_scans[name]['bytes']), cleaned_name])
 
     # Create the HTML row list for top 10 users
     user_rows = ''
@@ -237,25 +348,12 @@ def get_nb_count():
                 'files_total': 0}
 
     if not test_run:
-        # Weekly query
-        cmd_out = subprocess.getstatusoutput("find " + data_dir + " -type f -not -path '*/\.*' -mtime -7 -name *.ipynb | wc -l")[1]
-        user_week = int(cmd_out.strip())
-        nb_count['week'] += user_week
-
-        # Total query
-        cmd_out = subprocess.getstatusoutput("find " + data_dir + " -type f -not -path '*/\.*' -name *.ipynb | wc -l")[1]
-        user_total = int(cmd_out.strip())
-        nb_count['total'] += user_total
-
-        # All files query, weekly
-        cmd_out = subprocess.getstatusoutput("find " + data_dir + " -type f -not -path '*/\.*' -mtime -7 | wc -l")[1]
-        files_week = int(cmd_out.strip())
-        nb_count['files_week'] += files_week - user_week
-
-        # All files query, total
-        cmd_out = subprocess.getstatusoutput("find " + data_dir + " -type f -not -path '*/\.*' | wc -l")[1]
-        files_total = int(cmd_out.strip())
-        nb_count['files_total'] += files_total - user_total
+        # Notebooks and other files, in total and modified in the last week
+        total = scan_files()['total']
+        nb_count['week'] += total['notebooks_week']
+        nb_count['total'] += total['notebooks']
+        nb_count['files_week'] += total['files_week'] - total['notebooks_week']
+        nb_count['files_total'] += total['files'] - total['notebooks']
 
     return nb_count
 
@@ -481,7 +579,85 @@ def get_nb_updates():
     return nb_updates
 
 
+def _rollup_key(event_token, description):
+    """
+    Parse the tool, user or domain out of an event's description, the same way usage_endpoint.py keys its rollups
+    """
+    try:
+        if event_token == 'tool_run': return description.split('|')[2] or 'unknown'
+        elif event_token == 'project_launch': return description.split('|')[0]
+        elif event_token == 'labextension_load': return urlparse(description).hostname or 'unknown'
+    except (AttributeError, IndexError, ValueError): return 'unknown'  # Missing or malformed description
+    return None
+
+
+def _get_rollup_stats(start_date=None, end_date=None):
+    """
+    Compile event stats from the hourly rollups kept by usage_endpoint.py, rather than scanning every raw event
+    :return: The same structure as get_event_stats(), or None if the rollups are missing or incomplete
+    """
+    engine = create_engine(f'sqlite://{DB_PATH}', echo=False)
+    if not inspect(engine).has_table('rollups'): return None
+
+    with engine.connect() as connection:
+        # The rollups are only usable once they have been backfilled to cover the oldest event
+        earliest_event = connection.execute(text("SELECT min(created) FROM events")).scalar()
+        earliest_rollup = connection.execute(text("SELECT min(earliest) FROM rollups WHERE period = 'hour'")).scalar()
+        if earliest_event is not None and (earliest_rollup is None or earliest_rollup > earliest_event): return None
+
+        # Only whole hours can come from the rollups, the partial hours at either end are counted from the raw events
+        first_hour = start_date.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1) if start_date else None
+        last_hour = end_date.replace(minute=0, second=0, microsecond=0) if end_date else None
+        if first_hour and last_hour and first_hour > last_hour: first_hour = last_hour = end_date
+        # Bound as DateTime so they are formatted as the columns are stored, str() would drop zero microseconds
+        between = (bindparam('start', type_=DateTime), bindparam('end', type_=DateTime))
+        rows = connection.execute(text(
+            "SELECT event_token, key, sum(count), min(earliest), max(latest) FROM rollups "
+            "WHERE period = 'hour' AND bucket >= :start AND bucket < :end GROUP BY event_token, key").bindparams(*between),
+            {'start': first_hour or datetime.min, 'end': last_hour or datetime.max}).all()
+        totals = {(event_token, key): [count, datetime.fromisoformat(earliest), datetime.fromisoformat(latest)]
+                  for event_token, key, count, earliest, latest in rows}
+
+        # Same bounds as the raw events query in get_event_stats()
+        edges = []
+        if start_date: edges.append((start_date, first_hour))
+        if end_date and last_hour != end_date: edges.append((last_hour, end_date))
+        for edge_start, edge_end in edges:
+            raw = connection.execute(text(
+                "SELECT event_token, description, created FROM events WHERE created > :start AND created < :end"
+                if edge_start == start_date else
+                "SELECT event_token, description, created FROM events WHERE created >= :start AND created < :end"
+                ).bindparams(*between), {'start': edge_start, 'end': edge_end}).all()
+            for event_token, description, created in raw:
+                created = datetime.fromisoformat(created) if isinstance(created, str) else created
+                key = _rollup_key(event_token, description)
+                for k in (['', key] if key is not None else ['']):
+                    total = totals.setdefault((event_token, k), [0, created, created])
+                    total[0] += 1
+                    total[1], total[2] = min(total[1], created), max(total[2], created)
+
+    event_stats = {}
+    sub_keys = {'tool_run': 'tools', 'project_launch': 'users', 'labextension_load': 'domains'}
+    for (event_token, key), (count, earliest, latest) in totals.items():
+        event_token = event_token or 'unknown'  # Special case for unknown tokens
+        if event_token not in event_stats: event_stats[event_token] = {'count': 0}
+        if key == '': event_stats[event_token].update({'count': count, 'earliest': earliest, 'latest': latest})
+        elif event_token in sub_keys:
+            event_stats[event_token].setdefault(sub_keys[event_token], {})[key] = {'count': count}
+
+    # Ensure that the expected event types have at least been initialized
+    for event_token, sub_key in sub_keys.items():
+        if event_token not in event_stats: event_stats[event_token] = {'count': 0}
+        if sub_key not in event_stats[event_token]: event_stats[event_token][sub_key] = {}
+
+    return event_stats
+
+
 def get_event_stats(start_date=None, end_date=None):
+    # Prefer the pre-aggregated rollups when they are available
+    rollup_stats = _get_rollup_stats(start_date, end_date)
+    if rollup_stats is not None: return rollup_stats
+
     Base = declarative_base()
 
     class Database:
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+"""
+Load test and benchmark harness for the usage tracking service
+
+Starts usage_endpoint.make_app() in a child process against a temporary SQLite file, drives it with a
+mix of concurrent clients and prints the throughput and latency percentiles of each request type as JSON.
+
+Example, timing beacons while large reports run against a million-row table:
+
+    python usage_benchmark.py --seed-rows 1000000 --mix beacon=95,report=5 --report-path 'report/?limit=10000'
+"""
+
+from datetime import datetime, timedelta
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+
+
+TOKENS = ['labextension_load', 'tool_run', 'project_launch']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the g2nb usage tracking service')
+    parser.add_argument('-c', '--concurrency', type=int, default=50, help='Number of concurrent clients')
+    parser.add_argument('-d', '--duration', type=float, default=30, help='Seconds to run the benchmark for')
+    parser.add_argument('-m', '--mix', type=str, default='beacon=90,bulk=8,report=2',
+                        help='Relative weights of beacon, bulk and report requests')
+    parser.add_argument('-b', '--bulk-size', type=int, default=50, help='Number of events per bulk request')
+    parser.add_argument('-r', '--report-path', type=str, default='report/?limit=1000', help='Report URL to read')
+    parser.add_argument('-s', '--seed-rows', type=int, default=0, help='Number of events to load before starting')
+    parser.add_argument('--db', type=str, default=None, help='SQLite file to use, defaults to a temporary file')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Write the JSON results here as well as stdout')
+    return parser.parse_args()
+
+
+def random_event():
+    """Return a plausible event_token and description"""
+    event_token = random.choice(TOKENS)
+    if event_token == 'tool_run': description = f'gp|{random.randint(1, 1000)}|Tool{random.randint(1, 200)}'
+    elif event_token == 'project_launch': description = f'user{random.randint(1, 2000)}|project'
+    else: description = f'https://hub{random.randint(1, 20)}.g2nb.org/lab'
+    return event_token, description
+
+
+def seed(count, batch_size=10000):
+    """Load the database with events spread over the last year"""
+    import usage_endpoint
+    now = datetime.utcnow()
+    for start in range(0, count, batch_size):
+        events = []
+        for i in range(min(batch_size, count - start)):
+            event_token, description = random_event()
+            events.append({'event_token': event_token, 'description': description,
+                           'created': now - timedelta(seconds=random.randint(0, 365 * 24 * 3600))})
+        usage_endpoint.UsageEvent.save_all(events)
+
+
+def serve(db_path, port, seed_rows, ready):
+    """Run the usage service in this process, called in the child process"""
+    import usage_endpoint
+    from tornado.ioloop import IOLoop
+    usage_endpoint.DB_PATH = '/' + os.path.abspath(db_path)
+    if seed_rows: seed(seed_rows)
+    sys.setswitchinterval(usage_endpoint.SWITCH_INTERVAL)  # As the service's __main__ does
+
+    usage_endpoint.make_app().listen(port, address='127.0.0.1')
+    usage_endpoint.EventQueue.instance().start()
+    ready.set()
+    IOLoop.current().start()
+
+
+def percentile(latencies, p):
+    if not latencies: return None
+    return round(latencies[max(0, math.ceil(p / 100 * len(latencies)) - 1)] * 1000, 3)
+
+
+async def client(base_url, weights, args, deadline, results):
+    """Send a weighted random mix of requests until the deadline, recording each request's latency"""
+    http = AsyncHTTPClient()
+    operations, relative_weights = list(weights), list(weights.values())
+    while time.perf_counter() < deadline:
+        operation = random.choices(operations, weights=relative_weights)[0]
+        if operation == 'beacon':
+            event_token, description = random_event()
+            request = {'request': f'{base_url}{event_token}/', 'method': 'POST', 'body': description}
+        elif operation == 'bulk':
+            events = [dict(zip(['event_token', 'description'], random_event())) for i in range(args.bulk_size)]
+            request = {'request': f'{base_url}bulk/', 'method': 'POST', 'body': json.dumps(events)}
+        else: request = {'request': f'{base_url}{args.report_path}', 'method': 'GET'}
+
+        start = time.perf_counter()
+        try:
+            await http.fetch(**request, request_timeout=120)
+            results[operation]['latencies'].append(time.perf_counter() - start)
+        except (HTTPClientError, OSError):
+            results[operation]['errors'] += 1
+
+
+async def run(base_url, weights, args):
+    results = {operation: {'latencies': [], 'errors': 0} for operation in weights}
+    AsyncHTTPClient.configure(None, max_clients=args.concurrency)
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(*[client(base_url, weights, args, deadline, results) for i in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+
+    report = {'concurrency': args.concurrency, 'duration': round(elapsed, 3), 'seed_rows': args.seed_rows,
+              'mix': weights, 'operations': {}}
+    for operation, result in results.items():
+        latencies = sorted(result['latencies'])
+        report['operations'][operation] = {
+            'requests': len(latencies),
+            'errors': result['errors'],
+            'throughput': round(len(latencies) / elapsed, 2),
+            'events_per_second': round(len(latencies) * (args.bulk_size if operation == 'bulk' else 1) / elapsed, 2)
+                                 if operation != 'report' else None,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'max_ms': percentile(latencies, 100)}
+    return report
+
+
+def main():
+    args = parse_args()
+    weights = {k: float(v) for k, v in (part.split('=') for part in args.mix.split(','))}
+    unknown = set(weights) - {'beacon', 'bulk', 'report'}
+    if unknown: sys.exit(f'Unknown request types in mix: {", ".join(unknown)}')
+
+    # Find a free port for the service
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    temp_dir = tempfile.TemporaryDirectory()
+    db_path = args.db or os.path.join(temp_dir.name, 'usage.sqlite')
+    ready = multiprocessing.Event()
+    service = multiprocessing.Process(target=serve, args=(db_path, port, args.seed_rows, ready), daemon=True)
+    service.start()
+    if not ready.wait(timeout=3600): sys.exit('Usage service failed to start')
+
+    try: report = asyncio.run(run(f'http://127.0.0.1:{port}/services/usage/', weights, args))
+    finally:
+        service.terminate()
+        service.join()
+        temp_dir.cleanup()
+
+    output = json.dumps(report, indent=4)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f: f.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,39 @@
-from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, create_engine
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import Column, Integer, String, DateTime, Index, LargeBinary, UniqueConstraint, create_engine, event, func, select, tuple_
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.orm import declarative_base, sessionmaker
+from tornado.iostream import StreamClosedError
 from tornado.web import Application, RequestHandler
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
+import argparse
+import asyncio
+import atexit
+import csv
+import gzip
+import hashlib
+import io
+import json
 import logging
+import math
+import os
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from urllib.parse import urlparse
 
 
 Base = declarative_base()
 DB_PATH = '//data/usage.sqlite'  # '//Users/tmtabor/workspace/workspace/usage.sqlite'
+ARCHIVE_PATH = '/data/usage-archive'  # Where raw events past the retention window are archived
+RETENTION_DAYS = 365                  # Number of days of raw events to keep in DB_PATH
+SWITCH_INTERVAL = 0.001               # Seconds a busy thread may hold the GIL before the service's IOLoop gets a turn
 
 
 class Database:
@@ -15,11 +41,62 @@ class Database:
     db = None
     Session = None
 
+    READ_WORKERS = 4            # Number of threads available for report queries
+    NETWORK_FILESYSTEMS = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'lustre', 'glusterfs', 'ceph', 'fuse.sshfs'}
+
     def __init__(self):
-        self.db = create_engine(f'sqlite://{DB_PATH}', echo=False)
+        self.db = create_engine(f'sqlite://{DB_PATH}', echo=False, connect_args={'timeout': 30})
+        self.journal_mode = os.getenv('USAGE_JOURNAL_MODE') or Database.default_journal_mode(DB_PATH[1:])
+        event.listen(self.db, 'connect', self._set_pragmas)
         self.Session = sessionmaker(bind=self.db)
         Base.metadata.create_all(self.db)
 
+        # create_all() skips indexes on tables that already exist, so add any that are missing from older databases
+        for index in UsageEvent.__table__.indexes: index.create(self.db, checkfirst=True)
+
+        # All database work happens off the IOLoop: writes are serialized on one thread, reads get a small pool
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='usage-writer')
+        self.reader = ThreadPoolExecutor(max_workers=Database.READ_WORKERS, thread_name_prefix='usage-reader')
+
+    def _set_pragmas(self, dbapi_connection, connection_record):
+        # Incremental vacuuming only takes effect here for new databases, see vacuum() for existing ones
+        dbapi_connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        # Write-ahead logging lets report queries read while a batch of events is being written
+        dbapi_connection.execute(f'PRAGMA journal_mode={self.journal_mode}')
+        if self.journal_mode.upper() == 'WAL': dbapi_connection.execute('PRAGMA synchronous=NORMAL')
+
+    @staticmethod
+    def default_journal_mode(path):
+        """Return WAL, unless the database is on a network filesystem (ex: NFS or EFS), where SQLite can't share
+           the WAL index between hosts and the rollback journal has to be used instead"""
+        path, mount, fstype = os.path.realpath(os.path.dirname(path) or '.'), '', None
+        try:
+            with open('/proc/mounts') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) < 3: continue
+                    if (path == fields[1] or path.startswith(fields[1].rstrip('/') + '/')) and len(fields[1]) >= len(mount):
+                        mount, fstype = fields[1], fields[2]
+        except OSError: pass
+        return 'DELETE' if fstype in Database.NETWORK_FILESYSTEMS else 'WAL'
+
+    def read(self, func, *args):
+        """Run a blocking read on the reader pool, returning an awaitable"""
+        return IOLoop.current().run_in_executor(self.reader, func, *args)
+
+    def write(self, func, *args):
+        """Run a blocking write on the writer thread, returning an awaitable"""
+        return IOLoop.current().run_in_executor(self.writer, func, *args)
+
+    def vacuum(self):
+        """Return free pages to the filesystem, without rewriting the whole database once it is in incremental mode"""
+        with self.db.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            if connection.exec_driver_sql('PRAGMA auto_vacuum').scalar() != 2:
+                # Databases created before incremental mode need one full VACUUM to switch over
+                connection.exec_driver_sql('PRAGMA auto_vacuum=INCREMENTAL')
+                connection.exec_driver_sql('VACUUM')
+            else: connection.exec_driver_sql('PRAGMA incremental_vacuum')
+
     @classmethod
     def instance(cls):
         if cls._db_singleton is None:
@@ -30,6 +107,9 @@ class Database:
 class UsageEvent(Base):
     """ORM model representing a usage event"""
     __tablename__ = 'events'
+    __table_args__ = (Index('ix_events_token_created', 'event_token', 'created'),
+                      Index('ix_events_token_id', 'event_token', 'id'),  # Pages filtered by token without sorting
+                      Index('ix_events_created', 'created'))
 
     id = Column(Integer, primary_key=True)
     event_token = Column(String(127))
@@ -46,25 +126,506 @@ class UsageEvent(Base):
         session.commit()
         session.close()
 
+    @staticmethod
+    def save_all(events):
+        """Insert a list of event dicts in a single transaction"""
+        with Database.instance().db.begin() as connection:
+            connection.execute(UsageEvent.__table__.insert(), events)
+            UsageRollup.update(connection, events)
+            EventSketch.update(connection, events)
+
     def json(self):
         data = { c.name: getattr(self, c.name) for c in self.__table__.columns }
         for k in data:
             if isinstance(data[k], datetime): data[k] = str(data[k])  # Special case for datetimes
         return data
 
-    def get(event_token=None):
-        # Query the database
+    def get(event_token=None, start=None, end=None, after=None, limit=None):
+        # Query the database, filtering by token and time window and paging by id
         session = Database.instance().Session()
         query = session.query(UsageEvent)
         if event_token is not None: query = query.filter(UsageEvent.event_token == event_token)
+        if start is not None: query = query.filter(UsageEvent.created >= start)
+        if end is not None: query = query.filter(UsageEvent.created < end)
+        if after is not None: query = query.filter(UsageEvent.id > after)
+        query = query.order_by(UsageEvent.id)
+        if limit is not None: query = query.limit(limit)
         results = query.all()
         session.close()
         return results
 
+    @staticmethod
+    def select_rows(event_token=None, start=None, end=None, after=None, limit=None):
+        """Return a Core select of raw event rows, filtered the same way as get()"""
+        table = UsageEvent.__table__
+        statement = select(table.c.id, table.c.event_token, table.c.description, table.c.created)
+        if event_token is not None: statement = statement.where(table.c.event_token == event_token)
+        if start is not None: statement = statement.where(table.c.created >= start)
+        if end is not None: statement = statement.where(table.c.created < end)
+        if after is not None: statement = statement.where(table.c.id > after)
+        statement = statement.order_by(table.c.id)
+        if limit is not None: statement = statement.limit(limit)
+        return statement
+
+    @staticmethod
+    def watermark():
+        """Return the lowest and highest event ids, which change whenever events are added or archived"""
+        # Separate queries, as SQLite only reads min() or max() straight from the primary key when it's the only aggregate
+        table = UsageEvent.__table__
+        with Database.instance().db.connect() as connection:
+            return (connection.execute(select(func.min(table.c.id))).scalar(),
+                    connection.execute(select(func.max(table.c.id))).scalar())
+
+    @staticmethod
+    def rows(**params):
+        """Return a list of raw event rows as tuples, skipping the ORM"""
+        with Database.instance().db.connect() as connection:
+            return connection.execute(UsageEvent.select_rows(**params)).all()
+
+
+class UsageRollup(Base):
+    """ORM model representing the number of usage events in an hour or a day"""
+    __tablename__ = 'rollups'
+    __table_args__ = (UniqueConstraint('period', 'bucket', 'event_token', 'key', name='uq_rollups_bucket'),)
+
+    PERIODS = {'hour': {'minute': 0, 'second': 0, 'microsecond': 0},  # Fields cleared to find each period's bucket
+               'day': {'hour': 0, 'minute': 0, 'second': 0, 'microsecond': 0}}
+
+    id = Column(Integer, primary_key=True)
+    period = Column(String(8))           # Either hour or day
+    bucket = Column(DateTime)            # Start of the hour or day being counted
+    event_token = Column(String(127))
+    key = Column(String(255))            # Tool, user or domain parsed from the description, blank for the token total
+    count = Column(Integer, default=0)
+    earliest = Column(DateTime)
+    latest = Column(DateTime)
+
+    def json(self):
+        data = { c.name: getattr(self, c.name) for c in self.__table__.columns }
+        for k in data:
+            if isinstance(data[k], datetime): data[k] = str(data[k])  # Special case for datetimes
+        return data
+
+    @staticmethod
+    def key_for(event_token, description):
+        """Parse the tool, user or domain out of an event's description, mirroring get_event_stats() in stats.py"""
+        try:
+            if event_token == 'tool_run': return description.split('|')[2] or 'unknown'
+            elif event_token == 'project_launch': return description.split('|')[0]
+            elif event_token == 'labextension_load': return urlparse(description).hostname or 'unknown'
+        except (AttributeError, IndexError, ValueError): return 'unknown'  # Missing or malformed description
+        return None
+
+    @staticmethod
+    def aggregate(events, totals=None):
+        """Add a list of event dicts to a dict of {(period, bucket, event_token, key): [count, earliest, latest]}"""
+        totals = {} if totals is None else totals
+        for e in events:
+            key = UsageRollup.key_for(e['event_token'], e['description'])
+            for period, truncate in UsageRollup.PERIODS.items():
+                bucket = e['created'].replace(**truncate)
+                for k in (['', key] if key is not None else ['']):
+                    total = totals.get((period, bucket, e['event_token'], k))
+                    if total is None: totals[(period, bucket, e['event_token'], k)] = [1, e['created'], e['created']]
+                    else:
+                        total[0] += 1
+                        total[1] = min(total[1], e['created'])
+                        total[2] = max(total[2], e['created'])
+        return totals
+
+    @staticmethod
+    def update(connection, events):
+        """Add a list of event dicts to the rollups, as part of the caller's transaction"""
+        UsageRollup.upsert(connection, UsageRollup.aggregate(events))
+
+    @staticmethod
+    def upsert(connection, totals):
+        """Add the aggregated totals to any existing rollup rows, inserting new rows as needed"""
+        if not totals: return
+        table = UsageRollup.__table__
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=['period', 'bucket', 'event_token', 'key'],
+            set_={'count': table.c.count + statement.excluded.count,
+                  'earliest': func.min(table.c.earliest, statement.excluded.earliest),
+                  'latest': func.max(table.c.latest, statement.excluded.latest)})
+        connection.execute(statement, [{'period': period, 'bucket': bucket, 'event_token': event_token, 'key': key,
+                                        'count': count, 'earliest': earliest, 'latest': latest}
+                                       for (period, bucket, event_token, key), (count, earliest, latest) in totals.items()])
+
+    @staticmethod
+    def covers_events(connection):
+        """Return whether the rollups reach back to the oldest raw event, i.e. whether they have been backfilled"""
+        events, rollups = UsageEvent.__table__, UsageRollup.__table__
+        earliest_event = connection.execute(select(func.min(events.c.created))).scalar()
+        earliest_rollup = connection.execute(
+            select(func.min(rollups.c.earliest)).where(rollups.c.period == 'hour')).scalar()
+        return earliest_event is None or (earliest_rollup is not None and earliest_rollup <= earliest_event)
+
+    @staticmethod
+    def backfill(batch_size=5000):
+        """Rebuild the rollups from the raw events table, return the number of events counted
+
+           Rollups from before the oldest raw event's day are kept, as their events may have been archived."""
+        counted = 0
+        events, rollups = UsageEvent.__table__, UsageRollup.__table__
+        with Database.instance().db.begin() as connection:
+            earliest_event = connection.execute(select(func.min(events.c.created))).scalar()
+            if earliest_event is None: return counted
+
+            # Deleting first takes SQLite's write lock, so no events can be added mid-rebuild
+            first_day = earliest_event.replace(**UsageRollup.PERIODS['day'])
+            connection.execute(rollups.delete().where(rollups.c.bucket >= first_day))
+            connection.execute(EventSketch.__table__.delete().where(EventSketch.__table__.c.day >= first_day))
+            result = connection.execution_options(stream_results=True).execute(UsageEvent.select_rows())
+            totals, sketches = {}, {}
+            for rows in result.partitions(batch_size):
+                events = [dict(zip(EventExporter.COLUMNS, row)) for row in rows]
+                UsageRollup.aggregate(events, totals)
+                EventSketch.aggregate(events, sketches)
+                counted += len(rows)
+            UsageRollup.upsert(connection, totals)
+            EventSketch.merge_into(connection, sketches)
+        return counted
+
+    @staticmethod
+    def get(period='day', event_token=None, start=None, end=None, after=None, limit=None):
+        # Query the database, paging in (bucket, event_token, key) order from the rollup with the id after
+        session = Database.instance().Session()
+        query = session.query(UsageRollup).filter(UsageRollup.period == period)
+        if event_token is not None: query = query.filter(UsageRollup.event_token == event_token)
+        if start is not None: query = query.filter(UsageRollup.bucket >= start)
+        if end is not None: query = query.filter(UsageRollup.bucket < end)
+        if after is not None:
+            previous = session.query(UsageRollup.bucket, UsageRollup.event_token, UsageRollup.key) \
+                .filter(UsageRollup.id == after).one_or_none()
+            if previous is None:  # The rollups were rebuilt by a backfill since the cursor was handed out
+                session.close()
+                return []
+            query = query.filter(tuple_(UsageRollup.bucket, UsageRollup.event_token, UsageRollup.key) > tuple_(*previous))
+        query = query.order_by(UsageRollup.bucket, UsageRollup.event_token, UsageRollup.key)
+        if limit is not None: query = query.limit(limit)
+        results = query.all()
+        session.close()
+        return results
+
+
+class HyperLogLog:
+    """Mergeable sketch for estimating the number of distinct values in a set
+
+       With the default precision of 12 bits (4096 one-byte registers) the standard error is 1.04 / sqrt(4096),
+       about 1.6%, so roughly 95% of estimates fall within 3.3% of the exact count. Small sets are counted
+       using linear counting, which is close to exact below a few hundred values."""
+
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.size)
+
+    def add(self, value):
+        # Stable 64-bit hash, unlike hash() which changes between processes
+        hashed = int.from_bytes(hashlib.blake2b(value.encode('UTF-8'), digest_size=8).digest(), 'big')
+        index = hashed >> (64 - self.precision)
+        remainder = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remainder.bit_length() + 1  # Position of the first set bit
+        if rank > self.registers[index]: self.registers[index] = rank
+
+    def merge(self, other):
+        """Fold another sketch of the same precision into this one"""
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+    def count(self):
+        """Return the estimated number of distinct values added"""
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size * self.size / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.size and zeros: estimate = self.size * math.log(self.size / zeros)
+        return round(estimate)
+
+    @property
+    def error(self):
+        """Standard error of count(), as a fraction of the true count"""
+        return 1.04 / math.sqrt(self.size)
+
+    def serialize(self):
+        return zlib.compress(bytes(self.registers))  # Mostly empty registers compress very well
+
+    @staticmethod
+    def deserialize(data, precision=12):
+        return HyperLogLog(precision, zlib.decompress(data))
+
+
+class EventSketch(Base):
+    """ORM model representing a HyperLogLog sketch of the distinct users, tools or domains seen for a token in a day"""
+    __tablename__ = 'sketches'
+    __table_args__ = (UniqueConstraint('day', 'event_token', name='uq_sketches_day'),)
+
+    id = Column(Integer, primary_key=True)
+    day = Column(DateTime)
+    event_token = Column(String(127))
+    registers = Column(LargeBinary)
+
+    @staticmethod
+    def aggregate(events, sketches=None):
+        """Add the tool, user or domain of each event to a dict of {(day, event_token): HyperLogLog}"""
+        sketches = {} if sketches is None else sketches
+        for e in events:
+            key = UsageRollup.key_for(e['event_token'], e['description'])
+            if key is None: continue
+            day = e['created'].replace(**UsageRollup.PERIODS['day'])
+            if (day, e['event_token']) not in sketches: sketches[(day, e['event_token'])] = HyperLogLog()
+            sketches[(day, e['event_token'])].add(key)
+        return sketches
+
+    @staticmethod
+    def update(connection, events):
+        """Add a list of event dicts to the day's sketches, as part of the caller's transaction"""
+        EventSketch.merge_into(connection, EventSketch.aggregate(events))
+
+    @staticmethod
+    def merge_into(connection, sketches):
+        """Merge sketches into the stored ones, only safe on the database writer thread or inside a write lock"""
+        table = EventSketch.__table__
+        for (day, event_token), sketch in sketches.items():
+            stored = connection.execute(select(table.c.registers).where(
+                table.c.day == day, table.c.event_token == event_token)).scalar()
+            if stored is not None: sketch.merge(HyperLogLog.deserialize(stored))
+            connection.execute(insert(table).on_conflict_do_update(
+                index_elements=['day', 'event_token'], set_={'registers': sketch.serialize()}),
+                {'day': day, 'event_token': event_token, 'registers': sketch.serialize()})
+
+    @staticmethod
+    def whole_days(start=None, end=None):
+        """Widen a date range out to the whole UTC days that the sketches cover"""
+        if start is not None: start = start.replace(**UsageRollup.PERIODS['day'])
+        if end is not None and end != end.replace(**UsageRollup.PERIODS['day']):
+            end = end.replace(**UsageRollup.PERIODS['day']) + timedelta(days=1)
+        return start, end
+
+    @staticmethod
+    def distinct(event_token, start=None, end=None):
+        """Merge the daily sketches for the date range, widened to whole days, return the merged sketch"""
+        table = EventSketch.__table__
+        start, end = EventSketch.whole_days(start, end)
+        statement = select(table.c.registers).where(table.c.event_token == event_token)
+        if start is not None: statement = statement.where(table.c.day >= start)
+        if end is not None: statement = statement.where(table.c.day < end)
+        merged = HyperLogLog()
+        with Database.instance().db.connect() as connection:
+            for registers in connection.execute(statement).scalars(): merged.merge(HyperLogLog.deserialize(registers))
+        return merged
+
+    @staticmethod
+    def exact(event_token, start=None, end=None):
+        """Count distinct values by scanning the raw events over the same whole days, for checking the sketches"""
+        start, end = EventSketch.whole_days(start, end)
+        with Database.instance().db.connect() as connection:
+            rows = connection.execute(UsageEvent.select_rows(event_token=event_token, start=start, end=end))
+            return len({UsageRollup.key_for(event_token, description) for id, token, description, created in rows})
+
+    @staticmethod
+    def verifiable_start(start=None):
+        """Return the first whole day from start that still has raw events, or None if none are left
+
+           Days archived by EventArchive.retain() are only counted in the sketches, so exact() can't check them.
+           retain() archives whole days, so every day from the earliest raw event on is complete."""
+        table = UsageEvent.__table__
+        statement = select(func.min(table.c.created))
+        if start is not None: statement = statement.where(table.c.created >= EventSketch.whole_days(start)[0])
+        with Database.instance().db.connect() as connection: earliest = connection.execute(statement).scalar()
+        return earliest.replace(**UsageRollup.PERIODS['day']) if earliest is not None else None
+
+
+class EventArchive:
+    """Moves raw events past the retention window out of the database and into gzipped, per-month SQLite files"""
+
+    def __init__(self, archive_dir=ARCHIVE_PATH):
+        self.archive_dir = archive_dir
+
+    def path(self, month):
+        return os.path.join(self.archive_dir, f'events-{month:%Y-%m}.sqlite.gz')
+
+    def append(self, month, rows):
+        """Add raw event rows to the month's archive, creating it if necessary, return the number of rows added"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = self.path(month)
+        with tempfile.TemporaryDirectory(dir=self.archive_dir) as temp_dir:
+            # Unpack any existing archive for the month so the rows can be added to it
+            db_path = os.path.join(temp_dir, 'events.sqlite')
+            if os.path.exists(path):
+                with gzip.open(path, 'rb') as src, open(db_path, 'wb') as dst: shutil.copyfileobj(src, dst)
+
+            # Ignore rows already archived, so that an interrupted run can simply be repeated
+            connection = sqlite3.connect(db_path)
+            connection.execute('CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, event_token VARCHAR(127), '
+                               'description VARCHAR(255), created DATETIME)')
+            added = connection.executemany('INSERT OR IGNORE INTO events VALUES (?, ?, ?, ?)',
+                                           ((id, event_token, description, str(created))
+                                            for id, event_token, description, created in rows)).rowcount
+            connection.commit()
+            connection.close()
+
+            # Compress next to the old archive, then swap it in
+            with open(db_path, 'rb') as src, gzip.open(f'{path}.tmp', 'wb') as dst: shutil.copyfileobj(src, dst)
+            os.replace(f'{path}.tmp', path)
+        return added
+
+    def retain(self, days=RETENTION_DAYS, batch_size=5000):
+        """Archive and delete raw events older than the given number of days, return the number of events archived"""
+        database = Database.instance()
+        table = UsageEvent.__table__
+        cutoff = (datetime.utcnow() - timedelta(days=days)).replace(**UsageRollup.PERIODS['day'])
+
+        # Make sure every event about to be removed has been counted in the rollups
+        with database.db.connect() as connection:
+            if not UsageRollup.covers_events(connection): UsageRollup.backfill()
+
+        # Move one month at a time, so that the database is only locked for one month's delete
+        archived = 0
+        while True:
+            with database.db.connect() as connection:
+                oldest = connection.execute(select(func.min(table.c.created)).where(table.c.created < cutoff)).scalar()
+            if oldest is None: break
+            month = oldest.replace(day=1, **UsageRollup.PERIODS['day'])
+            end = min((month + timedelta(days=32)).replace(day=1), cutoff)
+
+            with database.db.connect() as connection:
+                result = connection.execution_options(stream_results=True).execute(UsageEvent.select_rows(start=month, end=end))
+                self.append(month, (row for rows in result.partitions(batch_size) for row in rows))
+            with database.db.begin() as connection:
+                archived += connection.execute(table.delete().where(table.c.created >= month, table.c.created < end)).rowcount
+
+        database.vacuum()
+        return archived
+
+
+class EventExporter:
+    """Encodes raw event rows as NDJSON or CSV, chunk by chunk, optionally gzip-compressed"""
+
+    COLUMNS = ['id', 'event_token', 'description', 'created']
+    FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+    def __init__(self, format='ndjson', compress=False):
+        if format not in EventExporter.FORMATS: raise ValueError(f'Unknown export format: {format}')
+        self.format = format
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits=31 is a gzip stream
+        self.started = False
+
+    @property
+    def content_type(self):
+        return 'application/gzip' if self.compressor else EventExporter.FORMATS[self.format]
+
+    @property
+    def file_name(self):
+        return f'usage-events.{self.format}' + ('.gz' if self.compressor else '')
+
+    def encode(self, rows):
+        """Encode a chunk of rows, return the bytes to send"""
+        buffer = io.StringIO()
+        if self.format == 'csv':
+            writer = csv.writer(buffer)
+            if not self.started: writer.writerow(EventExporter.COLUMNS)
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                buffer.write(json.dumps(dict(zip(EventExporter.COLUMNS, row)), default=str))
+                buffer.write('\n')
+        self.started = True
+        data = buffer.getvalue().encode('UTF-8')
+        return self.compressor.compress(data) if self.compressor else data
+
+    def finish(self):
+        """Return any remaining bytes, including the CSV header if no rows were exported"""
+        data = self.encode([]) if not self.started else b''
+        return data + self.compressor.flush() if self.compressor else data
+
+
+class EventQueue:
+    """Buffers incoming usage events in memory and writes them to the database in batches"""
+    _queue_singleton = None
+
+    BATCH_SIZE = 500        # Flush as soon as this many events are waiting
+    FLUSH_INTERVAL = 1000   # Otherwise flush every this many milliseconds
+    MAX_BACKLOG = 100000    # Drop new events once this many are waiting to be written
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.flush_scheduled = False
+        self.counters = {'received': 0, 'dropped': 0, 'written': 0, 'flushes': 0, 'failed_flushes': 0,
+                         'last_flush_ms': 0.0, 'max_flush_ms': 0.0}
+
+    @classmethod
+    def instance(cls):
+        if cls._queue_singleton is None:
+            cls._queue_singleton = EventQueue()
+        return cls._queue_singleton
+
+    def start(self):
+        """Begin flushing on a timer and make sure waiting events are written on exit"""
+        PeriodicCallback(self.schedule_flush, self.FLUSH_INTERVAL).start()
+        atexit.register(self.flush)
+
+    def schedule_flush(self):
+        """Hand a flush to the database writer thread, unless one is already waiting there"""
+        with self.lock:
+            if self.flush_scheduled or not self.events: return
+            self.flush_scheduled = True
+        Database.instance().writer.submit(self.flush)
+
+    def put(self, event_token, description):
+        """Queue an event for writing, return False if the backlog is full and the event was dropped"""
+        with self.lock:
+            if len(self.events) >= self.MAX_BACKLOG:
+                self.counters['dropped'] += 1
+                return False
+            # Timestamp the event now, rather than when it is eventually written
+            self.events.append({'event_token': event_token, 'description': description, 'created': datetime.utcnow()})
+            self.counters['received'] += 1
+            batch_ready = len(self.events) >= self.BATCH_SIZE
+
+        # Don't wait for the timer if a full batch is already waiting
+        if batch_ready: self.schedule_flush()
+        return True
+
+    def flush(self):
+        """Write all waiting events to the database in a single transaction"""
+        with self.lock:
+            batch, self.events = self.events, []
+            self.flush_scheduled = False
+        if not batch: return
+
+        start = time.perf_counter()
+        try: UsageEvent.save_all(batch)
+        except Exception as e:
+            # Put the batch back at the front of the queue, dropping the oldest events if over the backlog cap
+            logging.error(f'Unable to write {len(batch)} usage events: {e}')
+            with self.lock:
+                waiting = batch + self.events
+                self.counters['dropped'] += max(0, len(waiting) - self.MAX_BACKLOG)
+                self.counters['failed_flushes'] += 1
+                self.events = waiting[-self.MAX_BACKLOG:]
+            return
+        elapsed = (time.perf_counter() - start) * 1000
+
+        with self.lock:
+            self.counters['written'] += len(batch)
+            self.counters['flushes'] += 1
+            self.counters['last_flush_ms'] = round(elapsed, 3)
+            self.counters['max_flush_ms'] = max(self.counters['max_flush_ms'], round(elapsed, 3))
+
+    def stats(self):
+        """Return the current queue depth and flush counters"""
+        with self.lock:
+            return {'depth': len(self.events), **self.counters}
+
 
 class UsageHandler(RequestHandler):
     """Endpoint for tracking g2nb usage"""
 
+    RETRY_AFTER = 5  # Seconds clients are asked to wait before resending an event dropped because the queue is full
+
     def set_default_headers(self):
         """Handle CORS requests"""
         self.set_header("Access-Control-Allow-Origin", "*")
@@ -84,8 +645,13 @@ class UsageHandler(RequestHandler):
         # Get the optional description if included, cap at 256 characters
         description = self.request.body[:256].decode('UTF-8') or None
 
-        # Write the event_token and description to the database
-        UsageEvent(event_token=event_token, description=description).save()
+        # Queue the event_token and description to be written to the database, asking the client to retry if it's full
+        if not EventQueue.instance().put(event_token, description):
+            self.set_status(503)
+            self.set_header('Retry-After', str(UsageHandler.RETRY_AFTER))
+            self.write('Usage event queue is full')
+            self.finish()
+            return
 
         # Return a basic response
         self.write('OK')
@@ -96,9 +662,129 @@ class UsageHandler(RequestHandler):
         return self.get(event_token=event_token)
 
 
+class ReportCache:
+    """Keeps the most recently requested reports serialized and gzipped, until the events table changes"""
+    _cache_singleton = None
+
+    MAX_ENTRIES = 64                    # Number of distinct reports to keep
+    MAX_BODY_SIZE = 16 * 1024 * 1024    # Reports larger than this are not cached
+
+    class Entry:
+        """A serialized report, built on a database reader thread as encoding and compressing it is slow"""
+        def __init__(self, watermark, body):
+            self.watermark = watermark
+            self.body = body.encode('UTF-8')
+            # Reports too large to cache are sent uncompressed rather than gzipped for a single use
+            self.gzipped = gzip.compress(self.body) if len(self.body) <= ReportCache.MAX_BODY_SIZE else None
+            self.etag = f'"{hashlib.sha1(self.body).hexdigest()}"'
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.counters = {'hits': 0, 'misses': 0}
+
+    @classmethod
+    def instance(cls):
+        if cls._cache_singleton is None:
+            cls._cache_singleton = ReportCache()
+        return cls._cache_singleton
+
+    def get(self, key, watermark):
+        """Return the cached report, or None if it is missing or the events table has changed since"""
+        entry = self.entries.get(key)
+        if entry is None or entry.watermark != watermark:
+            self.counters['misses'] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.counters['hits'] += 1
+        return entry
+
+    def put(self, key, entry):
+        """Cache a report, replacing any older version and evicting the least recently used reports"""
+        if entry.gzipped is None: return entry
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > ReportCache.MAX_ENTRIES: self.entries.popitem(last=False)
+        return entry
+
+    def stats(self):
+        return {'entries': len(self.entries), **self.counters}
+
+
+class BulkUsageHandler(RequestHandler):
+    """Endpoint for tracking many g2nb usage events in one request"""
+
+    MAX_EVENTS = 1000                       # Largest number of events accepted per request
+    CLOCK_WINDOW = timedelta(hours=24)      # Client timestamps further than this from server time are ignored
+
+    def set_default_headers(self):
+        """Handle CORS requests"""
+        self.set_header("Access-Control-Allow-Origin", "*")
+        self.set_header("Access-Control-Allow-Headers", "x-requested-with, content-type")
+        self.set_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
+
+    def options(self):
+        self.set_status(204)
+        self.finish()
+
+    async def post(self):
+        """Record a JSON array or NDJSON body of {event_token, description, client_timestamp} events
+
+           All events are written in a single transaction. Returns the number of events recorded."""
+        try: events = self.parse_events(self.request.body.decode('UTF-8'))
+        except ValueError as e:
+            self.send_error(400, reason=str(e))
+            return
+        if len(events) > BulkUsageHandler.MAX_EVENTS:
+            self.send_error(413, reason=f'No more than {BulkUsageHandler.MAX_EVENTS} events may be sent at once')
+            return
+
+        if events: await Database.instance().write(UsageEvent.save_all, events)
+        self.write({'recorded': len(events)})
+        self.finish()
+
+    @staticmethod
+    def parse_events(body):
+        """Parse and validate the request body, raise ValueError if it is malformed"""
+        try:
+            if body.lstrip().startswith('['): records = json.loads(body)
+            else: records = [json.loads(line) for line in body.splitlines() if line.strip()]
+        except json.JSONDecodeError as e: raise ValueError(f'Invalid JSON: {e}')
+
+        now = datetime.utcnow()
+        events = []
+        for record in records:
+            if not isinstance(record, dict) or not isinstance(record.get('event_token'), str):
+                raise ValueError('Each event must be an object with an event_token')
+            description = record.get('description')
+            if description is not None and not isinstance(description, str):
+                raise ValueError('Event descriptions must be strings')
+
+            # Same caps as UsageHandler: 128 characters for the event_token and 256 for the description
+            events.append({'event_token': record['event_token'][:128],
+                           'description': description[:256] if description else None,
+                           'created': BulkUsageHandler.parse_timestamp(record.get('client_timestamp'), now)})
+        return events
+
+    @staticmethod
+    def parse_timestamp(client_timestamp, now):
+        """Use the client's ISO 8601 or epoch millisecond timestamp if it is plausible, otherwise the server's time"""
+        try:
+            if isinstance(client_timestamp, (int, float)): created = datetime.fromtimestamp(client_timestamp / 1000, timezone.utc)
+            elif isinstance(client_timestamp, str): created = datetime.fromisoformat(client_timestamp.replace('Z', '+00:00'))
+            else: return now
+        except (ValueError, OverflowError, OSError): return now
+
+        # Store naive UTC, the same as datetime.utcnow()
+        if created.tzinfo is not None: created = created.astimezone(timezone.utc).replace(tzinfo=None)
+        return created if abs(now - created) <= BulkUsageHandler.CLOCK_WINDOW else now
+
+
 class ReportHandler(RequestHandler):
     """Endpoint for reporting g2nb usage"""
 
+    PAGE_SIZE = 1000       # Number of events returned per page if no limit is given
+    MAX_PAGE_SIZE = 10000  # Largest page a client may request
+
     def set_default_headers(self):
         """Handle CORS requests"""
         self.set_header("Access-Control-Allow-Origin", "*")
@@ -109,24 +795,265 @@ class ReportHandler(RequestHandler):
         self.set_status(204)
         self.finish()
 
-    def get(self, event_token=None):
-        """List usage events in JSON format"""
-        results = UsageEvent.get()
-        events = [e.json() for e in results]
-        self.write({'events': events})
+    async def get(self, event_token=None):
+        """List a page of usage events in JSON format
+
+           Accepts the optional query parameters event_token, start and end (ISO 8601, UTC),
+           limit and cursor. Pass the returned next value as the cursor to get the following page."""
+        try: params = self.report_params()
+        except ValueError as e:
+            self.send_error(400, reason=str(e))
+            return
+
+        await self.write_cached(lambda: ReportHandler.query(params))
+
+    async def write_cached(self, query):
+        """Send a report from the cache, running the query on a reader thread only if the events have changed
+
+           Answers If-None-Match with 304 and sends the pre-compressed body to clients that accept gzip."""
+        key = (self.request.path, tuple(sorted((k, tuple(v)) for k, v in self.request.query_arguments.items())))
+        watermark = await Database.instance().read(UsageEvent.watermark)
+        entry = ReportCache.instance().get(key, watermark)
+        if entry is None:
+            entry = await Database.instance().read(lambda: ReportCache.Entry(watermark, query()))
+            ReportCache.instance().put(key, entry)
+
+        # The gzip and identity bodies are different representations, so each gets its own strong ETag
+        gzipped = entry.gzipped is not None and 'gzip' in self.request.headers.get('Accept-Encoding', '')
+        self.set_header('ETag', f'{entry.etag[:-1]}-gzip"' if gzipped else entry.etag)
+        self.set_header('Vary', 'Accept-Encoding')
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return
+
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        if gzipped:
+            self.set_header('Content-Encoding', 'gzip')
+            self.write(entry.gzipped)
+        else: self.write(entry.body)
+        self.finish()
+
+    def report_params(self):
+        """Parse and validate the report's query parameters, raise ValueError if any are invalid"""
+        params = {'event_token': self.get_argument('event_token', None)}
+        for arg in ['start', 'end']:
+            value = self.get_argument(arg, None)
+            try: params[arg] = ReportHandler.parse_date(value) if value else None
+            except ValueError: raise ValueError(f'Invalid {arg} date: {value}')
+        try:
+            cursor = self.get_argument('cursor', None)
+            params['after'] = int(cursor) if cursor else None
+            params['limit'] = int(self.get_argument('limit', ReportHandler.PAGE_SIZE))
+        except ValueError: raise ValueError('Invalid cursor or limit')
+        if params['limit'] < 1 or params['limit'] > ReportHandler.MAX_PAGE_SIZE:
+            raise ValueError(f'Limit must be between 1 and {ReportHandler.MAX_PAGE_SIZE}')
+        return params
+
+    @staticmethod
+    def parse_date(value):
+        """Parse an ISO 8601 date, converting any timezone to naive UTC to match the stored events"""
+        date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if date.tzinfo is not None: date = date.astimezone(timezone.utc).replace(tzinfo=None)
+        return date
+
+    @staticmethod
+    def query(params):
+        """Query and serialize one page of the report, runs on a database reader thread"""
+        # Fetch one extra event to know whether there is another page
+        results = UsageEvent.get(**{**params, 'limit': params['limit'] + 1})
+        more = len(results) > params['limit']
+        events = [e.json() for e in results[:params['limit']]]
+        return json.dumps({'events': events, 'next': str(events[-1]['id']) if more else None})
+
+
+class ExportHandler(ReportHandler):
+    """Endpoint for streaming the full usage events table"""
+
+    BATCH_SIZE = 5000  # Number of events read from the database and sent per chunk
+
+    async def get(self, event_token=None):
+        """Stream usage events as NDJSON or CSV
+
+           Accepts the same filters as the report, plus format (ndjson or csv) and gzip (true or false)."""
+        try:
+            params = self.report_params()
+            exporter = EventExporter(self.get_argument('format', 'ndjson'),
+                                     self.get_argument('gzip', 'false').lower() in ['true', '1'])
+        except ValueError as e:
+            self.send_error(400, reason=str(e))
+            return
+        del params['limit']
+
+        self.set_header('Content-Type', exporter.content_type)
+        self.set_header('Content-Disposition', f'attachment; filename={exporter.file_name}')
+
+        # Page through the table by id, so only one chunk is ever held in memory
+        try:
+            while True:
+                after, data = await Database.instance().read(ExportHandler.read_chunk, exporter, params)
+                if after is None: break
+                self.write(data)
+                await self.flush()
+                params['after'] = after
+            self.write(exporter.finish())
+            self.finish()
+        except StreamClosedError:
+            logging.info('Client disconnected during usage export')
+
+    @staticmethod
+    def read_chunk(exporter, params):
+        """Read and encode the next chunk of events on a database reader thread, as encoding is as slow as the query
+
+           Returns the id of the last event read and the encoded chunk, or None and no data at the end of the table."""
+        rows = UsageEvent.rows(**params, limit=ExportHandler.BATCH_SIZE)
+        if not rows: return None, b''
+        return rows[-1][0], exporter.encode(rows)
+
+
+class RollupHandler(ReportHandler):
+    """Endpoint for reporting pre-aggregated g2nb usage"""
+
+    async def get(self, event_token=None):
+        """List a page of hourly or daily event counts in JSON format
+
+           Accepts period (hour or day) and the report's event_token, start, end, limit and cursor parameters."""
+        try: params = self.report_params()
+        except ValueError as e:
+            self.send_error(400, reason=str(e))
+            return
+        period = self.get_argument('period', 'day')
+        if period not in UsageRollup.PERIODS:
+            self.send_error(400, reason=f'Unknown period: {period}')
+            return
+
+        await self.write_cached(lambda: RollupHandler.query(period, params))
+
+    @staticmethod
+    def query(period, params):
+        """Query and serialize one page of rollups, runs on a database reader thread"""
+        # Fetch one extra rollup to know whether there is another page
+        results = UsageRollup.get(period=period, **{**params, 'limit': params['limit'] + 1})
+        more = len(results) > params['limit']
+        rollups = [r.json() for r in results[:params['limit']]]
+        return json.dumps({'rollups': rollups, 'next': str(rollups[-1]['id']) if more else None})
+
+
+class DistinctHandler(ReportHandler):
+    """Endpoint for reporting approximate distinct users, tools or domains"""
+
+    async def get(self, event_token=None):
+        """Return the estimated number of distinct users (project_launch), tools (tool_run) or domains
+           (labextension_load) for the event_token between start and end, in JSON format"""
+        try: params = self.report_params()
+        except ValueError as e:
+            self.send_error(400, reason=str(e))
+            return
+        if params['event_token'] is None:
+            self.send_error(400, reason='An event_token is required')
+            return
+
+        def query():
+            sketch = EventSketch.distinct(params['event_token'], params['start'], params['end'])
+            return json.dumps({'event_token': params['event_token'], 'distinct': sketch.count(),
+                               'standard_error': round(sketch.error, 4)})
+        await self.write_cached(query)
+
+
+class StatusHandler(RequestHandler):
+    """Endpoint for monitoring the usage service's ingestion queue"""
+
+    def get(self):
+        """Return the ingestion queue's and report cache's counters in JSON format"""
+        self.write({'queue': EventQueue.instance().stats(), 'report_cache': ReportCache.instance().stats()})
         self.finish()
 
 
 def make_app():
     # Assign handlers to the URLs and return
     urls = [(r"/services/usage/report/", ReportHandler),
+            (r"/services/usage/export/", ExportHandler),
+            (r"/services/usage/rollup/", RollupHandler),
+            (r"/services/usage/distinct/", DistinctHandler),
+            (r"/services/usage/status/", StatusHandler),
+            (r"/services/usage/bulk/", BulkUsageHandler),
             (r"/services/usage/(?P<event_token>.*)/", UsageHandler)]
     return Application(urls, debug=True)
 
 
+def export(args):
+    """Stream the events table to a file or stdout from the command line"""
+    exporter = EventExporter(args.format, args.gzip)
+    statement = UsageEvent.select_rows(event_token=args.event_token, start=args.start, end=args.end)
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    with Database.instance().db.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(statement)
+        for rows in result.partitions(ExportHandler.BATCH_SIZE):
+            out.write(exporter.encode(rows))
+            out.flush()
+    out.write(exporter.finish())
+    if args.output: out.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='g2nb usage tracking service')
+    commands = parser.add_subparsers(dest='command')
+    export_parser = commands.add_parser('export', help='Stream usage events to a file as NDJSON or CSV')
+    export_parser.add_argument('-f', '--format', choices=list(EventExporter.FORMATS), default='ndjson', help='Output format')
+    export_parser.add_argument('-z', '--gzip', action='store_true', help='Gzip-compress the output')
+    export_parser.add_argument('-o', '--output', type=str, default=None, help='Output file, defaults to stdout')
+    export_parser.add_argument('-t', '--event-token', type=str, default=None, help='Only export this event token')
+    export_parser.add_argument('-s', '--start', type=ReportHandler.parse_date, default=None, help='Earliest date to export (UTC)')
+    export_parser.add_argument('-e', '--end', type=ReportHandler.parse_date, default=None, help='Date to export up to (UTC)')
+    commands.add_parser('backfill', help='Rebuild the rollups and distinct count sketches from the raw events')
+    distinct_parser = commands.add_parser('distinct', help='Estimate distinct users, tools or domains for a token')
+    distinct_parser.add_argument('event_token', type=str, help='project_launch, tool_run or labextension_load')
+    distinct_parser.add_argument('-s', '--start', type=ReportHandler.parse_date, default=None, help='Earliest date to count (UTC)')
+    distinct_parser.add_argument('-e', '--end', type=ReportHandler.parse_date, default=None, help='Date to count up to (UTC)')
+    distinct_parser.add_argument('-v', '--verify', action='store_true',
+                                 help='Compare with an exact count of the raw events, over the days not yet archived')
+    retain_parser = commands.add_parser('retain', help='Archive raw events past the retention window and vacuum')
+    retain_parser.add_argument('-d', '--days', type=int, default=RETENTION_DAYS, help='Days of raw events to keep')
+    retain_parser.add_argument('-a', '--archive', type=str, default=ARCHIVE_PATH, help='Directory for the monthly archives')
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
+    args = parse_args()
+    if args.command == 'export':
+        export(args)
+        sys.exit(0)
+    elif args.command == 'backfill':
+        print(f'Rolled up {UsageRollup.backfill()} usage events')
+        sys.exit(0)
+    elif args.command == 'distinct':
+        sketch = EventSketch.distinct(args.event_token, args.start, args.end)
+        print(f'Estimated distinct: {sketch.count()} (standard error {sketch.error:.1%})')
+        if args.verify:
+            start = EventSketch.verifiable_start(args.start)
+            if start is None or (args.end is not None and start >= args.end): print('No raw events left to verify against')
+            else:
+                print(f'Estimated distinct from {start:%Y-%m-%d}, the earliest day not archived: '
+                      f'{EventSketch.distinct(args.event_token, start, args.end).count()}')
+                print(f'Exact distinct from {start:%Y-%m-%d}: {EventSketch.exact(args.event_token, start, args.end)}')
+        sys.exit(0)
+    elif args.command == 'retain':
+        print(f'Archived {EventArchive(args.archive).retain(args.days)} usage events')
+        sys.exit(0)
+
     logging.info(f'Usage Tracking Service started on 3003')
 
+    # Serializing large reports on the reader threads is CPU bound, so have them hand the GIL back sooner than the
+    # default 5 ms to keep beacons fast. Only the service does this, the commands above don't share an IOLoop
+    sys.setswitchinterval(SWITCH_INTERVAL)
+
     app = make_app()
     app.listen(3003)
-    IOLoop.instance().start()
\ No newline at end of file
+
+    # Flush queued events on a timer, and stop the loop cleanly when JupyterHub stops the service
+    EventQueue.instance().start()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_event_loop().add_signal_handler(sig, IOLoop.current().stop)
+    IOLoop.instance().start()
+    Database.instance().writer.shutdown(wait=True)
+    EventQueue.instance().flush()
\ No newline at end of file
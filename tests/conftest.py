@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The services are standalone scripts rather than a package, so import them from the scripts directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
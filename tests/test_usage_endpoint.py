@@ -0,0 +1,174 @@
+from datetime import datetime, timedelta
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import sqlite3
+import time
+
+import pytest
+
+import usage_benchmark
+import usage_endpoint
+
+
+SEED_ROWS = int(os.getenv('USAGE_TEST_ROWS', 0))         # Size of the events table the latency test runs against, ex: 1000000
+BEACON_CLIENTS = 10                                      # Concurrent clients sending beacons
+PHASE_SECONDS = 5                                        # How long beacon latency is measured for, alone and loaded
+
+
+def seed_raw_events(db_path, count, batch_size=50000):
+    """Create the schema and insert raw events directly, much faster than save_all() as no rollups are kept"""
+    usage_endpoint.DB_PATH = '/' + db_path
+    usage_endpoint.Database._db_singleton = None
+    usage_endpoint.Database.instance().db.dispose()
+    usage_endpoint.Database._db_singleton = None
+
+    now = datetime.utcnow()
+    db = sqlite3.connect(db_path)
+    for start in range(0, count, batch_size):
+        rows = []
+        for i in range(min(batch_size, count - start)):
+            event_token, description = usage_benchmark.random_event()
+            created = now - timedelta(seconds=random.randint(0, 365 * 24 * 3600))
+            rows.append((event_token, description, str(created)))
+        db.executemany('INSERT INTO events (event_token, description, created) VALUES (?, ?, ?)', rows)
+        db.commit()
+    db.close()
+
+
+def start_service(db_path):
+    """Run the usage service in a fresh child process, return it and its base URL"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    service = context.Process(target=usage_benchmark.serve, args=(db_path, port, 0, ready), daemon=True)
+    service.start()
+    assert ready.wait(timeout=120), 'Usage service failed to start'
+    return service, f'http://127.0.0.1:{port}/services/usage/'
+
+
+async def beacon_latencies(base_url, duration):
+    """Send beacons from several clients for duration seconds, return the sorted latencies"""
+    http = AsyncHTTPClient()
+    latencies, deadline = [], time.perf_counter() + duration
+
+    async def client():
+        while time.perf_counter() < deadline:
+            event_token, description = usage_benchmark.random_event()
+            start = time.perf_counter()
+            await http.fetch(f'{base_url}{event_token}/', method='POST', body=description, request_timeout=60)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[client() for i in range(BEACON_CLIENTS)])
+    return sorted(latencies)
+
+
+def export_forever(base_url, clients):
+    """Stream the whole events table over and over, discarding the body, called in a child process"""
+    os.nice(19)  # Reading the exports shouldn't take CPU from the beacon clients being measured
+
+    async def export():
+        http = AsyncHTTPClient()
+        while True:
+            try: await http.fetch(f'{base_url}export/', streaming_callback=lambda chunk: None, request_timeout=3600)
+            except HTTPClientError: pass
+
+    async def run():
+        await asyncio.gather(*[export() for i in range(clients)])
+    asyncio.run(run())
+
+
+async def compare(base_url):
+    """Return the beacon latencies without and then with exports running, from a separate process so reading
+       the exports doesn't slow the beacon clients"""
+    AsyncHTTPClient.configure(None, max_clients=BEACON_CLIENTS)
+    alone = await beacon_latencies(base_url, PHASE_SECONDS)
+    exporter = multiprocessing.get_context('spawn').Process(target=export_forever, args=(base_url, 2), daemon=True)
+    exporter.start()
+    try:
+        await asyncio.sleep(2)  # Let the exports get going
+        loaded = await beacon_latencies(base_url, PHASE_SECONDS)
+    finally:
+        exporter.terminate()
+        exporter.join()
+    return alone, loaded
+
+
+@pytest.mark.skipif(not SEED_ROWS, reason='Slow and timing dependent, set USAGE_TEST_ROWS to run it')
+def test_beacon_p99_unaffected_by_concurrent_export(tmp_path):
+    db_path = str(tmp_path / 'usage.sqlite')
+    seed_raw_events(db_path, SEED_ROWS)
+    service, base_url = start_service(db_path)
+    try: alone, loaded = asyncio.run(compare(base_url))
+    finally:
+        service.terminate()
+        service.join()
+
+    p99_alone = usage_benchmark.percentile(alone, 99)
+    p99_loaded = usage_benchmark.percentile(loaded, 99)
+    print(f'Beacon p99 {p99_alone} ms alone, {p99_loaded} ms during exports of {SEED_ROWS} events')
+
+    # Exports share the CPU with the beacons, so allow some slowdown on small machines, but nothing like the IOLoop
+    # waiting on a query or serializing a chunk of the export itself
+    assert p99_loaded <= max(3 * p99_alone, p99_alone + 100)
+
+
+def use_database(db_path):
+    """Point usage_endpoint at a fresh database file"""
+    if usage_endpoint.Database._db_singleton is not None: usage_endpoint.Database._db_singleton.db.dispose()
+    usage_endpoint.DB_PATH = '/' + db_path
+    usage_endpoint.Database._db_singleton = None
+
+
+def within_error(sketch, exact):
+    """Whether the sketch's estimate is within 3 standard errors of the exact count
+
+       Small sets are linear counted, where a few colliding values matter more than the percentage error"""
+    return abs(sketch.count() - exact) <= max(5, 3 * sketch.error * exact)
+
+
+@pytest.mark.parametrize('count', [0, 1, 10, 100, 1000, 10000, 100000])
+def test_hyperloglog_count(count):
+    sketch = usage_endpoint.HyperLogLog()
+    for i in range(count): sketch.add(f'user{i}')
+    for i in range(count): sketch.add(f'user{i}')  # Repeats must not change the estimate
+    assert within_error(sketch, count)
+
+
+def test_hyperloglog_merge():
+    first, second = usage_endpoint.HyperLogLog(), usage_endpoint.HyperLogLog()
+    for i in range(0, 60000): first.add(f'tool{i}')
+    for i in range(40000, 100000): second.add(f'tool{i}')
+    assert within_error(first, 60000) and within_error(second, 60000)
+
+    # The union of the overlapping sets, the same after a round trip through the database's serialized form
+    merged = usage_endpoint.HyperLogLog().merge(first).merge(second)
+    assert within_error(merged, 100000)
+    restored = usage_endpoint.HyperLogLog.deserialize(merged.serialize())
+    assert restored.count() == merged.count()
+
+
+def test_distinct_matches_exact_count(tmp_path):
+    use_database(str(tmp_path / 'usage.sqlite'))
+    random.seed(10)
+    start = datetime(2024, 3, 1)
+    events = []
+    for day in range(14):
+        # Each day sees a different but overlapping set of users and tools, as real days do
+        for i in range(2000):
+            created = start + timedelta(days=day, seconds=random.randint(0, 24 * 3600 - 1))
+            events.append({'event_token': 'project_launch', 'created': created,
+                           'description': f'user{random.randint(day * 300, day * 300 + 3000)}|project'})
+            events.append({'event_token': 'tool_run', 'created': created,
+                           'description': f'gp|{i}|Tool{random.randint(1, 200)}'})
+    usage_endpoint.UsageEvent.save_all(events)
+
+    for event_token in ['project_launch', 'tool_run']:
+        for window in [(None, None), (start, start + timedelta(days=1)), (start + timedelta(days=3, hours=5), start + timedelta(days=10))]:
+            sketch = usage_endpoint.EventSketch.distinct(event_token, *window)
+            assert within_error(sketch, usage_endpoint.EventSketch.exact(event_token, *window)), (event_token, window)